@@ -33,7 +33,8 @@
 #
 # Thus, we need to look for other workarounds. Namely, we will be using coroutines. 
 # The solution in this script is built using [this code piece written by David Lechner](https://gist.github.com/dlech/fa48f9b2a3a661c79c2c5880684b63ae).
-# Full credit goes to him. The use of coroutines in this program is explained later on (inside the function `play_drums`).
+# Full credit goes to him. The coroutines are run by `uasyncio` (MicroPython's version of `asyncio`).
+# The use of coroutines in this program is explained later on (inside the function `play_drums`).
 #
 # # Required robot
 # * Charlie (with basic drum set)
@@ -63,9 +64,11 @@ from mindstorms.operator import greater_than, greater_than_or_equal_to, less_tha
 import math
 
 # %%
-# Required for our own timer implementation.
+# Required for our own runtime implementation.
 from utime import sleep as wait_for_seconds
-from utime import ticks_diff, ticks_ms
+from utime import ticks_diff, ticks_ms, ticks_us, sleep_us
+from array import array
+from hub import port, battery
 
 # %% [markdown]
 # # Initialization
@@ -73,6 +76,88 @@ from utime import ticks_diff, ticks_ms
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
+# %% [markdown]
+# ## Logging
+# Printing is slow on the hub (and building the strings of the messages allocates memory),
+# so we don't want to do it in every iteration of a loop. `log` only prints the messages
+# of the enabled levels. Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops.
+#
+# Messages are templates with `%` placeholders (e.g., `log.debug("Step %d", step)`), which are only
+# formatted when their level is enabled. With `every_ms`, a message is printed at most once per that many
+# milliseconds. The disabled levels are replaced by a function that does nothing. However, the arguments
+# of a message are still evaluated (and packed in a tuple) when we call it. Thus, in the hottest loops,
+# we check `log.enabled(Logger.DEBUG)` first, so that a disabled message costs (almost) nothing.
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %%
 hub = MSHub()
 app = App()
@@ -81,6 +166,154 @@ app = App()
 hub.status_light.on('black')
 
 
+# %% [markdown]
+# # Define an async runtime
+# Our coroutines need someone to run them. Luckily, MicroPython comes with `uasyncio`
+# (a reduced version of Python's [`asyncio`](https://docs.python.org/3/library/asyncio.html)).
+# It runs several coroutines (called *tasks*) at the same time. Every time a task waits
+# (e.g., `await runtime.sleep(0.5)`), the other ones can run. When nobody has anything to do,
+# the hub simply sleeps until the next task has to wake up.
+#
+# On top of it, we will define a small runtime with awaitable versions of the things we usually do
+# in our programs: waiting, moving motors, waiting for sensors and playing sounds.
+# The usual `run_to_position` blocks until the motor gets there. Thus, moving two motors
+# means moving one after the other. With the runtime, we can move both of them at the same time.
+
+# %%
+print("Defining async runtime...")
+
+# MicroPython calls the asyncio module uasyncio.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+class Runtime():
+    """
+    Small runtime (on top of uasyncio) for running several tasks at the same time.
+
+    It provides awaitable versions of the (blocking) things that our programs
+    usually do: sleeping, moving motors, waiting for sensors and playing sounds.
+    Motors are the "raw" ones (e.g., hub.port.B.motor), since their
+    run_to_position doesn't block.
+    """
+    TOLERANCE = 3 # Maximum position error (in degrees) for a move to be done.
+
+    def __init__(self, start_sound=None, poll_ms=10):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        start_sound:
+            Function that starts playing a sound (without waiting for it to finish).
+            Default value is None.
+        poll_ms:
+            How often (in ms) conditions are checked while waiting.
+            Default value is 10.
+        """
+        self.start_sound = start_sound
+        self.poll_ms = poll_ms
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the runtime clock.
+        """
+        self.elapsed_us = 0
+        self.last_ticks = ticks_us()
+
+    def now(self):
+        """
+        Returns the time (in us) since the runtime clock was last reset.
+        """
+        # We accumulate the elapsed time (instead of subtracting a start time),
+        # so the ticks can wrap around as many times as they want.
+        ticks = ticks_us()
+        self.elapsed_us += ticks_diff(ticks, self.last_ticks)
+        self.last_ticks = ticks
+        return self.elapsed_us
+
+    async def sleep(self, seconds):
+        """
+        Awaitable version of wait_for_seconds.
+        """
+        await asyncio.sleep(seconds)
+
+    async def sleep_until(self, t_us):
+        """
+        Sleeps until the given time (in us since the runtime clock was last reset).
+        """
+        # Other tasks can run during most of the wait (with ms resolution)...
+        delay_us = t_us - self.now()
+        if delay_us > 1000:
+            await asyncio.sleep((delay_us // 1000) / 1000)
+
+        # ...but we wait the last bit ourselves, to be on time to the us.
+        delay_us = t_us - self.now()
+        if delay_us > 0:
+            sleep_us(delay_us)
+
+    async def wait_until(self, condition, timeout=None):
+        """
+        Waits until condition() (e.g., a sensor check) is True.
+        Returns False if it took longer than timeout (in seconds).
+        """
+        if timeout is not None:
+            deadline = self.now() + int(timeout * 1000000)
+        while not condition():
+            if timeout is not None and self.now() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_ms / 1000)
+        return True
+
+    async def run_for_degrees(self, motor, degrees, speed=75, timeout=None):
+        """
+        Awaitable version of run_for_degrees.
+        Returns False if the motor didn't get there in time (e.g., it was blocked).
+        """
+        target = motor.get()[1] + degrees
+        motor.run_to_position(target, abs(speed))
+
+        done = False
+        try:
+            done = await self.wait_until(lambda: abs(motor.get()[1] - target) <= self.TOLERANCE, timeout)
+        finally:
+            # If the move timed out (or its task was cancelled), we stop the motor.
+            if not done:
+                motor.brake()
+        return done
+
+    async def run_to_position(self, motor, position, speed=75, timeout=None):
+        """
+        Awaitable version of run_to_position (using the shortest path).
+        Returns False if the motor didn't get there in time (e.g., it was blocked).
+        """
+        degrees = (position - motor.get()[2] + 180) % 360 - 180
+        return await self.run_for_degrees(motor, degrees, speed, timeout)
+
+    async def play_sound(self, name, seconds):
+        """
+        Awaitable version of play_sound. Since we can't know when a sound
+        is over, we need to give its duration (in seconds).
+        """
+        self.start_sound(name)
+        await asyncio.sleep(seconds)
+
+    def run(self, *coroutines):
+        """
+        Runs the given coroutines at the same time (until all of them are done).
+        """
+        async def main():
+            await asyncio.gather(*coroutines)
+        asyncio.run(main())
+
+print("DONE!")
+
+# %%
+runtime = Runtime(start_sound=app.start_sound)
+
+
 # %% [markdown]
 # # Configure motors
 
@@ -89,6 +322,10 @@ print("Configuring motors...")
 motor_left_arm = Motor('B') # Left arm
 motor_right_arm = Motor('F') # Right arm
 motors_arms = MotorPair('B', 'F')
+
+# "Raw" motors, for the awaitable moves of the runtime.
+raw_left_arm = port.B.motor
+raw_right_arm = port.F.motor
 print("DONE!")
 
 # %% [markdown]
@@ -96,61 +333,403 @@ print("DONE!")
 
 # %%
 print("Setting arm motors to position 0...")
-motor_left_arm.run_to_position(0)
-motor_right_arm.run_to_position(0)
+# Both arms move at the same time.
+runtime.run(runtime.run_to_position(raw_left_arm, 0), runtime.run_to_position(raw_right_arm, 0))
+print("DONE!")
+
+# %% [markdown]
+# # Define a beat clock
+# To stay in time, every stroke should happen exactly on its beat (or a fraction of it).
+# If we calculated the time of each stroke by adding the duration of one beat to the previous
+# stroke, any small error (e.g., rounding the beat duration to a whole microsecond or waking up
+# a bit late) would pile up. After a few bars, Charlie would be audibly off-beat.
+#
+# Instead, the beat clock calculates the time of every beat from the last tempo change
+# (i.e., `n` beats after it, we are `n * 60000000 // tempo` microseconds later). This way, errors never accumulate.
+# It also keeps some statistics of how late (or early) each beat was actually played.
+
+# %%
+print("Defining beat clock...")
+
+class BeatClock():
+    """
+    Converts beats into absolute times (in us since the beginning of the drumming)
+    and keeps statistics of the timing error of each beat.
+    """
+
+    def __init__(self, tempo, beats_per_bar=4):
+        """
+        Initialization
+        """
+        self.beats_per_bar = beats_per_bar
+        self.errors = array('i', [0] * beats_per_bar) # Worst error of each beat of the bar (in us).
+        self.origin_us = 0
+        self.origin_beat = 0
+        self.tempo = tempo
+        self.reset_stats()
+
+    def set_tempo(self, tempo, beat=0):
+        """
+        Changes the tempo from the given beat on.
+        """
+        self.origin_us = self.time(beat)
+        self.origin_beat = beat
+        self.tempo = tempo
+
+    def time(self, beat, subdivisions=1):
+        """
+        Returns the time (in us) of the given beat. With subdivisions, beat is
+        given in fractions of a beat (e.g., half beats with subdivisions=2).
+        """
+        return self.origin_us + (beat - self.origin_beat * subdivisions) * 60000000 // (self.tempo * subdivisions)
+
+    def reset_stats(self):
+        """
+        Resets the timing statistics.
+        """
+        self.n_strokes = 0
+        self.total_error_us = 0
+        self.max_error_us = 0
+        self.min_error_us = 0
+        for ii in range(self.beats_per_bar):
+            self.errors[ii] = 0
+
+    def record(self, beat, error_us):
+        """
+        Records the timing error (in us, positive if late) of a stroke of the given beat.
+        """
+        if self.n_strokes == 0:
+            self.max_error_us = error_us
+            self.min_error_us = error_us
+        else:
+            self.max_error_us = max(self.max_error_us, error_us)
+            self.min_error_us = min(self.min_error_us, error_us)
+        self.n_strokes += 1
+        self.total_error_us += error_us
+        beat = beat % self.beats_per_bar
+        if abs(error_us) > abs(self.errors[beat]):
+            self.errors[beat] = error_us
+
+    def print_stats(self):
+        """
+        Prints the timing statistics.
+        """
+        if self.n_strokes == 0:
+            return
+        print("Timing error: mean = " + str(self.total_error_us // self.n_strokes) + " us; "
+              + "max = " + str(self.max_error_us) + " us; min = " + str(self.min_error_us) + " us "
+              + "(" + str(self.n_strokes) + " strokes)")
+        print("Worst error of each beat of the bar: " + str(list(self.errors)) + " us")
+
 print("DONE!")
 
 # %% [markdown]
-# # Overwrite `Timer`
-# Unfortunately, `mindstorms.control.Timer` doesn't support floats.
-# Thus, we need to define our own timer (using the functionality of `utime`).
+# # Define songs
+# Instead of hard-coding what each arm does, we will write it down as a song.
+# A song is made of *patterns*. A pattern describes one bar: each bar is divided in
+# steps (by default, 8 steps, i.e., two per beat) and, for each stroke, we write down
+# which limb (`0` for the left arm, `1` for the right arm), in which step, and with which power.
+# To save memory, each pattern is stored in a `bytearray` (3 bytes per stroke).
+# Since a byte can't be negative, we store the power plus 128.
+#
+# Then, the song says which patterns are played (and for how many bars) and
+# the *tempo map* says at which bar the tempo changes.
+# No matter how long the song is, a pattern is stored only once.
+#
+# Songs are written as text (one command per line), so they can also be read from a file:
+#
+# ```
+# pattern basic      # Start a pattern called basic.
+# 0 0 50             # Limb, step, power.
+# ...
+# tempo 80           # From now on, play at 80 bpm.
+# play basic 4       # Play the pattern basic for 4 bars.
+# ```
 
 # %%
-print("Overwriting timer...")
+print("Defining songs...")
 
-class Timer():
+class Song():
     """
-    Replacement Timer class that allows using floats (i.e., seconds with a decimal place). 
+    Drum song: patterns, the order in which they are played (sections) and a tempo map.
     """
 
     def __init__(self):
         """
         Initialization
         """
-        self.start_ticks = 0
+        self.patterns = {} # Name: bytearray with (limb, step, power + 128) triples.
+        self.sections = [] # (pattern name, number of bars)
+        self.tempo_map = [] # (bar, tempo)
+        self.n_bars = 0
 
-    def now(self):
+    def add_pattern(self, name, strokes):
+        """
+        Adds a pattern given as a list of (limb, step, power) strokes.
         """
-        Returns the time (in seconds) since the timer was last reset.
+        pattern = bytearray(3 * len(strokes))
+        for ii, (limb, step, power) in enumerate(sorted(strokes, key=lambda stroke: stroke[1])):
+            pattern[3*ii] = limb
+            pattern[3*ii + 1] = step
+            pattern[3*ii + 2] = power + 128
+        self.patterns[name] = pattern
+
+    def set_tempo(self, tempo):
         """
-        return ticks_diff(ticks_ms(), self.start_ticks) / 1000
+        Changes the tempo (in bpm) from the next section on.
+        """
+        self.tempo_map.append((self.n_bars, tempo))
 
-    def reset(self):
+    def play(self, name, bars):
+        """
+        Adds a section that plays the given pattern for a number of bars.
+        """
+        self.sections.append((name, bars))
+        self.n_bars += bars
+
+    def parse(self, lines):
         """
-        Resets the timer
+        Reads a song written as text (see above).
         """
-        self.start_ticks = ticks_ms()
+        name = None
+        strokes = []
+        for line in lines:
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+
+            # Numbers are strokes of the current pattern. Anything else ends it.
+            if words[0] not in ('pattern', 'tempo', 'play'):
+                strokes.append((int(words[0]), int(words[1]), int(words[2])))
+                continue
+            if name is not None:
+                self.add_pattern(name, strokes)
+                name = None
+
+            if words[0] == 'pattern':
+                name = words[1]
+                strokes = []
+            elif words[0] == 'tempo':
+                self.set_tempo(int(words[1]))
+            else:
+                self.play(words[1], int(words[2]))
+
+        if name is not None:
+            self.add_pattern(name, strokes)
+        return self
+
+    def load(self, filename):
+        """
+        Reads a song from a (text) file.
+        """
+        with open(filename) as f:
+            return self.parse(f)
 
 print("DONE!")
 
 # %% [markdown]
 # # Make Charlie drum away
 #
-# First, we need to define a function for playing the drums
-# (equivalent to the block `Charlie plays drums`).
+# First, we need to define a sequencer, which plays the songs
+# (equivalent to the block `Charlie plays drums`, but much more flexible).
 #
 # Notice how we can define the default values of a function
-# (in this case, `bars=4` and `tempo=100`). Moreover, 
+# (in this case, `steps_per_beat=2` and `beats_per_bar=4`). Moreover, 
 # it is great practice that every time that we define a function,
 # we describe how it works (namely, what parameters it expects 
 # and what it returns).
 
 # %%
-timer_drums = Timer()
-background_timer_left = Timer()
-background_timer_right = Timer()
+class Sequencer():
+    """
+    Plays songs with Charlie's limbs.
+    """
+
+    def __init__(self, limbs, steps_per_beat=2, beats_per_bar=4):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        limbs:
+            Motors of the limbs (in the order used by the patterns).
+        steps_per_beat:
+            Number of steps in each beat.
+            Default value is 2.
+        beats_per_bar:
+            Number of beats in each bar.
+            Default value is 4 (i.e., a 4/4 tune).
+        """
+        self.limbs = limbs
+        self.steps_per_beat = steps_per_beat
+        self.beats_per_bar = beats_per_bar
+        self.steps_per_bar = steps_per_beat * beats_per_bar
+        self.latencies = array('i', [0] * len(limbs)) # Actuation latency of each limb (in us).
+
+    def calibrate(self, powers, repeats=3, threshold=2, timeout_ms=500):
+        """
+        Measures the actuation latency of each limb: the time between
+        start_at_power and the moment the encoder has moved threshold degrees.
+        Each limb goes back and forth repeats times (first with the given power
+        and then with the opposite one) and we keep the average.
+
+        Parameters
+        ----------
+        powers:
+            Power of the stroke of each limb (e.g., the one used in the patterns).
+        repeats:
+            Number of back and forth movements.
+            Default value is 3.
+        threshold:
+            Movement (in degrees) that counts as the beginning of the stroke.
+            Default value is 2.
+        timeout_ms:
+            Maximum time (in ms) to wait for the limb to move.
+            Default value is 500.
+        """
+        for ii, (limb, power) in enumerate(zip(self.limbs, powers)):
+            total_us = 0
+            for jj in range(2 * repeats):
+                limb.stop()
+                wait_for_seconds(0.2) # Let the limb settle.
+
+                start_position = limb.get_degrees_counted()
+                start_ticks = ticks_us()
+                limb.start_at_power(power if jj % 2 == 0 else -power)
+                while abs(limb.get_degrees_counted() - start_position) < threshold:
+                    if ticks_diff(ticks_us(), start_ticks) > timeout_ms * 1000:
+                        break
+                total_us += ticks_diff(ticks_us(), start_ticks)
+
+                # Let the limb complete (part of) its stroke.
+                wait_for_seconds(0.1)
+            limb.stop()
+            self.latencies[ii] = total_us // (2 * repeats)
+
+    def print_latencies(self):
+        """
+        Prints the actuation latency of each limb.
+        """
+        for ii, latency in enumerate(self.latencies):
+            print("Latency of limb " + str(ii) + " = " + str(latency) + " us")
+
+    def save_latencies(self, filename):
+        """
+        Appends the battery voltage (in mV) and the latencies (in us) to a file,
+        so that they can be compared across battery levels.
+        """
+        with open(filename, 'a') as f:
+            f.write(str(battery.voltage()) + "," + ",".join([str(latency) for latency in self.latencies]) + "\n")
+
+    def sort_by_lead(self, pattern):
+        """
+        Returns the indices of the strokes of a pattern in the order in which
+        they need to be issued: by step and, within each step, the limbs with
+        the longest latency first.
+        """
+        order = list(range(0, len(pattern), 3))
+        order.sort(key=lambda ii: (pattern[ii + 1], -self.latencies[pattern[ii]]))
+        return array('H', order)
+
+    async def play(self, song, beat_clock):
+        """
+        Plays a song. Every stroke is issued ahead of its time (by the latency of
+        its limb), so that the limb starts moving on time according to beat_clock.
+        """
+        steps_per_beat = self.steps_per_beat
+        latencies = self.latencies
+        tempo_map = song.tempo_map
+        n_tempos = len(tempo_map)
+        next_tempo = 0
+        bar = 0
+
+        # The song starts a bit later, so that there is time to issue the first strokes.
+        offset = max(latencies)
+
+        # This is the (only) dispatch loop. For each stroke, we wait until
+        # its step (minus the latency of the limb) and start moving the limb.
+        for name, bars in song.sections:
+            pattern = song.patterns[name]
+            order = self.sort_by_lead(pattern)
+            for _ in range(bars):
+
+                # Does the tempo change at this bar?
+                while next_tempo < n_tempos and tempo_map[next_tempo][0] <= bar:
+                    beat_clock.set_tempo(tempo_map[next_tempo][1], bar * self.beats_per_bar)
+                    log.debug("Bar %d: tempo = %d bpm", bar, tempo_map[next_tempo][1])
+                    next_tempo += 1
+
+                first_step = bar * self.steps_per_bar
+                for ii in order:
+                    limb = pattern[ii]
+                    step = first_step + pattern[ii + 1]
+                    t = offset + beat_clock.time(step, steps_per_beat) - latencies[limb]
+                    await runtime.sleep_until(t)
+                    error_us = runtime.now() - t
+                    self.limbs[limb].start_at_power(pattern[ii + 2] - 128)
+                    beat_clock.record(step // steps_per_beat, error_us)
+                    if log.enabled(Logger.DEBUG):
+                        log.debug("Step %d: limb %d issued %d us late", step, limb, error_us, every_ms=500)
+
+                    # The movement isn't immediate: it takes some time until
+                    # the arm starts moving. That's why we issued the stroke a bit earlier.
+
+                bar += 1
+
+        # We wait until the end of the last bar.
+        await runtime.sleep_until(offset + beat_clock.time(bar * self.beats_per_bar))
+
+# %% [markdown]
+# ## Compensate for the latency of the arms
+# So far, we assumed that an arm moves as soon as we tell it to. This isn't completely true:
+# it takes a bit until it actually starts moving, so the stick lands late.
+# Thus, we measure this latency for each arm (using its encoder) and the sequencer
+# issues each stroke that much earlier. We also save the latencies (together with the battery
+# voltage) in a file, so we can compare them across battery levels.
+#
+# Measuring swings both arms a few times and every measurement adds a line to the file in the hub.
+# Thus, it is disabled by default (and the latencies are 0). Set `CALIBRATE_LATENCIES` to `True` to enable it.
+
+# %%
+CALIBRATE_LATENCIES = False
+LATENCY_FILE = "charlie_latencies.csv"
+
+sequencer = Sequencer([motor_left_arm, motor_right_arm], steps_per_beat=2, beats_per_bar=4)
+
+
+# %% [markdown]
+# This is the song of the original `Drum solo` program. 
+# The left arm moves downwards during the first half of each beat and upwards during the second half.
+# The right arm takes the time of 4 beats (since we are in a 4/4 tune): it moves downwards for 2 beats
+# and upwards for the other 2. Notice that the right arm also uses a lower power. Otherwise
+# its trajectory is much longer. Originally, I wanted to try with 12.5 (rounded to 13)
+# (a reduction by a factor of 4). Unfortunately, that wasn't enough to move
+# the arm at all. Thus, I settled for a factor of 2.
+#
+# If you want Charlie to play another song, you can change it here (or save it in a
+# file in the hub and use `Song().load(filename)`).
 
-def play_drums(bars=4, tempo=100):
+# %%
+DRUM_SOLO = """
+pattern basic
+0 0 50
+0 1 -50
+0 2 50
+0 3 -50
+0 4 50
+0 5 -50
+0 6 50
+0 7 -50
+1 0 -25
+1 4 25
+
+tempo 80
+play basic 4
+tempo 130
+play basic 4
+"""
+
+def play_drums(song):
 
     """
     Makes Charlie play the drums.
@@ -161,140 +740,40 @@ def play_drums(bars=4, tempo=100):
     
     Parameters
     ----------
-    bars:
-        Number of bars (in our case, simple number of cycles).
-        Default value is 4.
-    tempo:
-        Playing tempo (in bpm).
-        Default value is 100
+    song:
+        Song to play.
             
     Returns
     -------
     None
     """
-    
-    # First, we will calculate how much should each beat last.
-    # We will convert the tempo [beats per minute] to period [s].
-    t_beat = 60 * (1/tempo)
-    print("t_beat = " + str(t_beat))
-
-    # Now, we will calculate how much each bar should last.
-    # We will assume a 4/4 tune.
-    t_bar = t_beat * 4
-    print("t_bar = " + str(t_bar))
-
-    # Lastly, we will calculate how much the whole drumming should last.
-    t_drumming = t_bar * bars
-    print("t_drumming = " + str(t_drumming))
-
-    # Now, this is where things get interesting. Bear with me.
-    # First, we need to define the coroutines.
-    # We need to define two: one for each arm (pretty much identical).
-    # Notice how the definition is very similar to that of a function.
-    # Coroutines also have input parameters.
-    # However, there is no "output" (i.e., return), but actually a yield.
-    def background_left_arm(t):
-        """
-        Parameters
-        ----------
-        t:
-            Time (in seconds) for which the left arm will execute this action.
-        """
-        background_timer_left.reset() # Make sure timer is on 0.
+    log.info("Playing %d bars...", song.n_bars)
+    beat_clock = BeatClock(song.tempo_map[0][1], beats_per_bar=4)
 
-        # Here, we check if the execution time of this arm has exceeded
-        # the desired duration (given by t).
-        while background_timer_left.now() < t:
-            
-            # If it hasn't, we reach this yield.
-            # yield lets the rest of the program run until we come back
-            # here again later to check if the condition was met.
-            yield
+    # The sequencer is a coroutine. It will NOT run here when we call it.
+    # Instead, it will just be created as a coroutine object, which the runtime will run.
+    # In between strokes, the hub just sleeps.
+    runtime.reset()
+    runtime.run(sequencer.play(song, beat_clock))
 
-    def background_right_arm(t):
-        """
-        Parameters
-        ----------
-        t:
-            Time (in seconds) for which the right arm will execute this action.
-        """
-        background_timer_right.reset()
-        while background_timer_right.now() < t:
-            yield
-
-    def drum_left_hand():
-        while True:
-
-            # This is how we receive a parameter.
-            # In this case, it corresponds to the time the action should last.
-            t_action = yield
-
-            # We make sure we only execute code if the received
-            # value was transmitted correctly.
-            if not t_action == None:
-                # We will start to move the arm downwards...
-                motor_left_arm.start_at_power(50)
-                
-                # ...and check if its duration exceeded the maximum allowed.
-                # Notice that we need to divide t_action by 2, since the action
-                # is composed of moving the arm downwards (first half)...
-                yield from background_left_arm(t_action/2)
-
-                # ...and upwards (second half, same process).
-                motor_left_arm.start_at_power(-50)
-                yield from background_left_arm(t_action/2)
-
-                # We assume that the movement is immediate and takes no time.
-                # This isn't completely true, but for now it works.
-
-
-    def drum_right_hand():
-
-        while True:
-            t_action = yield
-
-            if not t_action == None:
-                # It is worth mentioning a few things regarding the right arm's movement.
-                # - First, that we multiply t_action by 4 (since we are in a 4/4 tune).
-                # This is because we want the right arm to take the time of 4 beats.
-                # - Then, notice that the right arm also uses a lower power. Otherwise
-                # its trajectory is much longer. Originally, I wanted to try with 12.5 (rounded to 13)
-                # (a reduction by a factor of 4). Unfortunately, that wasn't enough to move
-                # the arm at all. Thus, I settled for a factor of 2.
-                motor_right_arm.start_at_power(-25)    
-                yield from background_right_arm((t_action/2)*4)
-                motor_right_arm.start_at_power(25)
-                yield from background_right_arm((t_action/2)*4)
-
-    # Since the drum_left_hand() and drum_right_hand() are coroutines and use yield
-    # (i.e., they are not functions and thus have no return), they will NOT
-    # run here when we call them. Instead, they will just be created as generator objects.
-    # These generators will be used to run the functions one yield (i.e., step) at a time.
-    left_generator = drum_left_hand()
-    right_generator = drum_right_hand()
-
-    # Now we will actually start the task.
-    # The task (playing the drums) will be run as long as its
-    # execution time is shorter than the allowed max duration (t_drumming).
-    timer_drums.reset()
-    while timer_drums.now() < t_drumming:
-        
-        next(left_generator)
-        left_generator.send(t_beat) # We send t_beat to the generator.
-
-        next(right_generator)
-        right_generator.send(t_beat)
-
-        wait_for_seconds(0.01) # Small pause between steps.
-        
-        # We also print the time in console.
-        print(str(timer_drums.now()))
+    # Finally, we can check how well Charlie kept the beat.
+    beat_clock.print_stats()
 
     return None
 
 
 # %% [markdown]
-# Now we can actually drum away!
+# Now we can actually drum away! But first, we measure the latencies of the arms (if enabled).
+
+# %%
+if CALIBRATE_LATENCIES:
+    runtime.run(runtime.run_to_position(raw_left_arm, 15), runtime.run_to_position(raw_right_arm, 345))
+
+    print("Measuring latencies...")
+    sequencer.calibrate([50, -25]) # Power of the strokes of each arm.
+    sequencer.print_latencies()
+    sequencer.save_latencies(LATENCY_FILE)
+    print("DONE!")
 
 # %%
 print("Starting drumming...")
@@ -302,11 +781,9 @@ print("Starting drumming...")
 app.start_sound('Triumph')
 hub.light_matrix.show_image('MUSIC_QUAVER')
 
-motor_left_arm.run_to_position(15)
-motor_right_arm.run_to_position(345)
+runtime.run(runtime.run_to_position(raw_left_arm, 15), runtime.run_to_position(raw_right_arm, 345))
 
-play_drums(bars=4, tempo=80)
-play_drums(bars=4, tempo=130)
+play_drums(Song().parse(DRUM_SOLO.split('\n')))
 
 print("DONE!")
 
@@ -314,8 +791,7 @@ print("DONE!")
 # %%
 print("Going for the finale...")
 
-motor_left_arm.run_to_position(15)
-motor_right_arm.run_to_position(345)
+runtime.run(runtime.run_to_position(raw_left_arm, 15), runtime.run_to_position(raw_right_arm, 345))
 
 for ii in range(0, 8):
 
@@ -325,8 +801,7 @@ for ii in range(0, 8):
     motors_arms.start_at_power(-50, steering=-100)
 
 app.play_sound('Tada')
-motor_left_arm.run_to_position(0, direction='shortest path')
-motor_right_arm.run_to_position(0, direction='shortest path')
+runtime.run(runtime.run_to_position(raw_left_arm, 0), runtime.run_to_position(raw_right_arm, 0))
 
 print("DONE!")
 
@@ -41,12 +41,93 @@ import math
 # %%
 import random # Needed to generate random numbers
 
+# %%
+# Required for logging and for measuring the reaction latency.
+from utime import ticks_add, ticks_diff, ticks_ms, ticks_us
+from array import array
+
 # %% [markdown]
 # # Initialization
 
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
+# %% [markdown]
+# ## Logging
+# Printing is slow on the hub, so `log` only prints the messages of the enabled levels.
+# Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops (take a look at Charlie's
+# [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %%
 hub = MSHub()
 app = App()
@@ -99,36 +180,222 @@ motors_wheels.start()
 
 
 # %% [markdown]
-# # Define distance function
-# As part of the program, we need to continuously check if the
-# measured distance is less than 25 cm. However, if the
-# sensor reads no measure, it will return a `None`, which
-# in turn will generate an error (since we cannot do a comparision
-# between a `None` and something else).
-#
-# To solve this, we will define our own cuestom distance function.
-# This way, when the sensor has no reading, we will just return
-# a (simulated) very long distance (instead of returning a `None`).
-# This will allow us to do the comparision.
+# # Sample the distance sensor
+# Instead of reading the sensor in every iteration of the loop, the `DistanceService`
+# reads it at a fixed rate (every 20 ms) and gives the median of the last three samples.
+# This way, the loop doesn't have to wait for the sensor every time, and a single
+# noisy sample doesn't make Charlie react. When the sensor has no reading, it
+# returns a `None` (which we can't compare with a number). In that case, the
+# service uses the range of the sensor (200 cm) instead.
 
 # %%
-def my_get_distance_cm():
+class DistanceService():
     """
-    Parameters
-    ----------
-    None
-        
-    Returns
-    -------
-    dist:
-        Distance value (in cm).
-        If the sensor returns a None, it returns a very large value (1000).
+    Reads the distance sensor at a fixed rate (at most once every period_ms,
+    no matter how often the program asks for the distance) and filters the
+    latest samples, so that a single noisy sample doesn't trigger anything.
     """
-    distance = distance_sensor.get_distance_cm()
-    if distance == None:
-        distance = 1000
-        
-    return distance
+
+    def __init__(self, sensor, period_ms=20, size=3, mode='median', alpha=0.5, max_cm=200):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        sensor:
+            Distance sensor (e.g., DistanceSensor('D')).
+        period_ms:
+            Sampling period (in ms).
+            Default value is 20.
+        size:
+            Number of samples of the median filter.
+            Default value is 3.
+        mode:
+            'median' or 'ema' (exponential moving average).
+            Default value is 'median'.
+        alpha:
+            Weight of the newest sample in the EMA (between 0 and 1).
+            Default value is 0.5.
+        max_cm:
+            Distance (in cm) used when the sensor doesn't see anything
+            (i.e., when it returns None).
+            Default value is 200 (the range of the sensor).
+        """
+        self.sensor = sensor
+        self.period_us = period_ms * 1000
+        self.mode = mode
+        self.alpha = alpha
+        self.max_cm = max_cm
+
+        self.samples = array('h', [max_cm] * size) # Ring buffer (in cm).
+        self.n_samples = 0
+        self.ema = max_cm
+        self.distance = max_cm
+        self.sample_ticks = None
+        self.next_ticks = 0
+
+        # [threshold, hysteresis, on_near, on_far, near]
+        self.thresholds = []
+
+    def add_threshold(self, threshold, on_near=None, on_far=None, hysteresis=3):
+        """
+        Calls on_near(distance) when the filtered distance drops below threshold,
+        and on_far(distance) when it goes back above threshold + hysteresis (in cm).
+        """
+        self.thresholds.append([threshold, hysteresis, on_near, on_far, False])
+
+    def update(self):
+        """
+        Takes a new sample if it is time to. Returns True if it did.
+        """
+        now = ticks_us()
+        if self.sample_ticks is not None and ticks_diff(now, self.next_ticks) < 0:
+            return False
+        self.sample(now)
+        return True
+
+    def sample(self, now):
+        """
+        Reads the sensor (now is the time of the read, from ticks_us())
+        and updates the filtered distance.
+        """
+        # If we missed a whole sample (e.g., because the program was busy moving),
+        # the older samples are stale. Thus, the filter starts over with this one.
+        if self.sample_ticks is not None and ticks_diff(now, self.sample_ticks) >= 2 * self.period_us:
+            self.n_samples = 0
+
+        distance = self.sensor.get_distance_cm()
+        if distance == None:
+            distance = self.max_cm
+        self.sample_ticks = now
+        # Keep the rate fixed, unless we are more than a period behind
+        # (e.g., because the program didn't ask for a while).
+        self.next_ticks = ticks_add(self.next_ticks, self.period_us)
+        if self.n_samples == 0 or ticks_diff(now, self.next_ticks) >= 0:
+            self.next_ticks = ticks_add(now, self.period_us)
+
+        self.samples[self.n_samples % len(self.samples)] = distance
+        self.n_samples += 1
+        if self.n_samples == 1:
+            self.ema = distance
+        else:
+            self.ema += self.alpha * (distance - self.ema)
+
+        if self.mode == 'ema':
+            self.distance = self.ema
+        else:
+            latest = sorted(self.samples[0:min(self.n_samples, len(self.samples))])
+            self.distance = latest[len(latest) // 2]
+
+        for threshold in self.thresholds:
+            if not threshold[4] and self.distance < threshold[0]:
+                threshold[4] = True
+                if threshold[2] is not None:
+                    threshold[2](self.distance)
+            elif threshold[4] and self.distance > threshold[0] + threshold[1]:
+                threshold[4] = False
+                if threshold[3] is not None:
+                    threshold[3](self.distance)
+
+    def value(self):
+        """
+        Returns the filtered distance (in cm), taking a new sample only if it is time to.
+        """
+        self.update()
+        return self.distance
+
+    def age_ms(self):
+        """
+        Returns how old the last sample is (in ms).
+        """
+        if self.sample_ticks is None:
+            return None
+        return ticks_diff(ticks_us(), self.sample_ticks) // 1000
+
+distance_service = DistanceService(distance_sensor)
+
+# %% [markdown]
+# # Measure the reaction latency
+# How long does it take to react to the sensor? The probe measures the time between
+# the sensor read that crossed the threshold and the first command issued in response
+# (i.e., how long the sensor reading, the checks and the prints in between take).
+# You can also measure it on your computer over many trials with
+# [`tools/reaction_benchmark.py`](https://github.com/arturomoncadatorres/lego-mindstorms/blob/main/tools/reaction_benchmark.py),
+# which is handy to check that a change didn't make the reaction slower.
+
+# %%
+class ReactionProbe():
+    """
+    Measures the reaction latency: the time between the sensor read that
+    crossed a threshold and the first actuator command issued in response.
+    """
+
+    def __init__(self, n_trials=100):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        n_trials:
+            Number of (latest) trials to keep.
+            Default value is 100.
+        """
+        self.latencies = array('i', [0] * n_trials) # Ring buffer (in us).
+        self.n_trials = 0
+        self.read_ticks = 0
+        self.trigger_ticks = None
+        self.last_trigger_ticks = None
+
+    def read(self, ticks=None):
+        """
+        Call right after every sensor read (or pass the time of the read,
+        from ticks_us(), if it happened earlier).
+        """
+        if ticks is None:
+            ticks = ticks_us()
+        self.read_ticks = ticks
+
+    def trigger(self):
+        """
+        Call when the last read crossed the threshold.
+        """
+        if self.trigger_ticks is None:
+            self.trigger_ticks = self.read_ticks
+
+    def react(self):
+        """
+        Call right before the first actuator command in response to the trigger.
+        """
+        if self.trigger_ticks is None:
+            return
+        self.latencies[self.n_trials % len(self.latencies)] = ticks_diff(ticks_us(), self.trigger_ticks)
+        self.n_trials += 1
+        self.last_trigger_ticks = self.trigger_ticks
+        self.trigger_ticks = None
+
+    def print_stats(self, bin_ms=5):
+        """
+        Prints the distribution of the reaction latency (with a histogram in bins of bin_ms).
+        """
+        n = min(self.n_trials, len(self.latencies))
+        if n == 0:
+            return
+        values = sorted(self.latencies[0:n])
+        print("Reaction latency (" + str(n) + " trials): min = " + str(values[0]) + " us; "
+              + "median = " + str(values[n // 2]) + " us; p90 = " + str(values[min(n - 1, 9 * n // 10)]) + " us; "
+              + "max = " + str(values[-1]) + " us")
+
+        bin_us = bin_ms * 1000
+        start = 0
+        while start < n:
+            low = values[start] // bin_us
+            end = start
+            while end < n and values[end] // bin_us == low:
+                end += 1
+            print("  " + str(low * bin_ms) + "-" + str((low + 1) * bin_ms) + " ms: " + "#" * (end - start) + " (" + str(end - start) + ")")
+            start = end
+
+probe = ReactionProbe()
 
 # %% [markdown]
 # We can now move on with the rest of the program
@@ -146,19 +413,22 @@ while True:
     # Check for color.
     color = color_sensor.get_color()
     if color == 'red':
-        print('Red color detected!')
+        log.info('Red color detected!')
 
         # This break will get us out of the while loop.
         break
 
     # Check for distance.
-    distance = my_get_distance_cm()
+    distance = distance_service.value()
+    probe.read(distance_service.sample_ticks)
     if distance < 25:
-        print("Distance sensor triggered!")
+        probe.trigger()
+        log.info("Distance sensor triggered!")
 
-        print("Generating random number...")
+        log.debug("Generating random number...")
         random_number = random.randint(1, 3)
-        print("Randon number = " + str(random_number) + ". Turning...")
+        log.info("Random number = %d. Turning...", random_number)
+        probe.react()
 
         # Define behaviour of each random number.
         if random_number == 1:
@@ -173,9 +443,11 @@ while True:
             # Here, we make sure that if the generated random number
             # wasn't expected, we send a notification to the user.
             # With the current program, we should never reach this case.
-            print("Invalid randon number. Doing nothing.")
+            log.warning("Invalid random number. Doing nothing.")
+
+        log.info("DONE!")
 
-        print("DONE!")
+        probe.print_stats()
 
 
 # %% [markdown]
@@ -38,12 +38,94 @@ import math
 # %%
 import random # Needed to generate random numbers
 
+# %%
+# Required for handling the buttons (and for logging).
+# Notice we use the buttons of the "raw" hub, since they can call us back when they are pressed.
+from hub import button
+from utime import ticks_diff, ticks_ms
+
 # %% [markdown]
 # # Initialization
 
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
+# %% [markdown]
+# ## Logging
+# Printing is slow on the hub, so `log` only prints the messages of the enabled levels.
+# Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops (take a look at Charlie's
+# [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %%
 hub = MSHub()
 app = App()
@@ -105,28 +187,169 @@ print("Chosen color is " + chosen_color + ". Shhh, don't tell anyone!")
 counter = 0
 guessed_color = colors[0]
 
+# %% [markdown]
+# Instead of checking each button ourselves, we tell `ButtonEvents` what to do
+# when each button is pressed. The firmware lets it know as soon as that happens
+# (even while the hub is showing that a guess was wrong), and it calls our
+# functions the next time we check in the loop.
+#
+# The right button shows the next color and the left button confirms the guess.
+
+# %%
+class ButtonEvents():
+    """
+    Calls a handler when a button of the hub is pressed, held down or released.
+
+    When the firmware can call us back when a button changes (button.callback),
+    the callback only records when it happened. The handlers are always called
+    from poll() (call it as often as possible, e.g., once per iteration of the
+    main loop), so they never run while the program is in the middle of
+    something else. poll() also checks the buttons without callback, gives the
+    'long_press' events and catches the changes that were ignored as bounces.
+    """
+
+    def __init__(self, debounce_ms=20, long_press_ms=800):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        debounce_ms:
+            Changes of a button within this time after the previous one are ignored.
+            Default value is 20.
+        long_press_ms:
+            A button that is held down this long gives a 'long_press' event
+            (right when it reaches this time, before it is released).
+            Default value is 800.
+        """
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        # name: [button, pressed, press_ticks, change_ticks, long_pressed, press_edge, release_edge]
+        # The edges are the ticks_ms() of the last press and release recorded
+        # by the callback since the last poll() (or -1).
+        self.buttons = {}
+        self.handlers = {} # (name, event): handler
+
+    def add_button(self, name, button):
+        """
+        Starts listening to a button (e.g., hub.button.left).
+        """
+        state = [button, False, 0, ticks_ms(), False, -1, -1]
+        self.buttons[name] = state
+        try:
+            # The firmware calls back with 0 when the button is pressed and with
+            # the time (in ms) that it was pressed when it is released.
+            button.callback(lambda time_ms: self.record(state, time_ms == 0))
+        except AttributeError:
+            pass
+
+    def record(self, state, pressed):
+        """
+        Records an edge of a button (called by the firmware).
+        """
+        state[5 if pressed else 6] = ticks_ms()
+
+    def on(self, name, event, handler):
+        """
+        Calls handler() on event ('press', 'long_press' or 'release') of the button name.
+        """
+        self.handlers[(name, event)] = handler
+
+    def emit(self, name, event):
+        """
+        Calls the handler of event of the button name (if any).
+        """
+        handler = self.handlers.get((name, event))
+        if handler is not None:
+            handler()
+
+    def change(self, name, pressed, ticks):
+        """
+        Handles a change of a button at ticks (ignoring it if it is a bounce).
+        """
+        state = self.buttons[name]
+        if pressed == state[1]:
+            return
+        if ticks_diff(ticks, state[3]) < self.debounce_ms:
+            return
+        state[1] = pressed
+        state[3] = ticks
+        if pressed:
+            state[2] = ticks
+            state[4] = False
+            self.emit(name, 'press')
+        else:
+            self.emit(name, 'release')
+
+    def poll(self):
+        """
+        Calls the handlers of the changes of the buttons since the last poll().
+        """
+        for name in self.buttons:
+            state = self.buttons[name]
+
+            # Edges recorded by the callback (in the order in which they happened).
+            press = state[5]
+            state[5] = -1
+            release = state[6]
+            state[6] = -1
+            if press >= 0 and release >= 0 and ticks_diff(release, press) < 0:
+                self.change(name, False, release)
+                release = -1
+            if press >= 0:
+                self.change(name, True, press)
+            if release >= 0:
+                self.change(name, False, release)
+
+            now = ticks_ms()
+            if ticks_diff(now, state[3]) >= self.debounce_ms:
+                self.change(name, state[0].is_pressed(), now)
+            if state[1] and not state[4] and ticks_diff(now, state[2]) >= self.long_press_ms:
+                state[4] = True
+                self.emit(name, 'long_press')
+
+
+# %%
+def next_color():
+    # Increase the counter by one (which shifts the color_idx).
+    global counter
+    counter += 1
+    log.info("Right button changed color to %s (color_idx = %d; counter = %d)", colors[counter % n_colors], counter % n_colors, counter)
+
+
+def confirm_guess():
+    # The guess is checked in the loop (since it takes a while).
+    global guess_confirmed
+    guess_confirmed = True
+
+
+guess_confirmed = False
+buttons = ButtonEvents()
+buttons.add_button('left', button.left)
+buttons.add_button('right', button.right)
+buttons.on('right', 'press', next_color)
+buttons.on('left', 'press', confirm_guess)
+
 # %%
 # We will loop as long as the user doesn't guess correctly.
 correct_guess = False
 while correct_guess == False:
 
+    # Handle what happened with the buttons since the last iteration.
+    buttons.poll()
+
     # Convert the counter to an index of the colors list.
     color_idx = counter % n_colors
 
     # Turn on the button with the corresponding color.
     hub.status_light.on(colors[color_idx])
 
-    if hub.right_button.was_pressed():
-        # If the right button was pressed, increase the counter by one
-        # and shift the color_idx.
-        counter += 1
-        color_idx = counter % n_colors
-        print("Right button changed color to " + colors[color_idx] + "(color_idx = " + str(color_idx) + "; counter = " + str(counter) + ")")
+    if guess_confirmed:
+        guess_confirmed = False
 
-    if hub.left_button.was_pressed():
         # If the left button was pressed, save the current color as the player's guess.
         guessed_color = colors[color_idx]
-        print("Guessed color is " + guessed_color)
+        log.info("Guessed color is %s", guessed_color)
 
         # Check if the player's guess was correct.
         if guessed_color == chosen_color:
@@ -137,7 +360,7 @@ while correct_guess == False:
             hub.light_matrix.show_image('YES')
             correct_guess = True # This makes sure we won't go through the loop again.
 
-            print("That is correct :) ! The chosen color was " + guessed_color + ". You win!")
+            log.info("That is correct :) ! The chosen color was %s. You win!", guessed_color)
             
 
         else:
@@ -165,7 +388,7 @@ while correct_guess == False:
             # Just for clarity.
             correct_guess = False
 
-            print("That is incorrect :( . Color " + guessed_color + " was removed.")
+            log.info("That is incorrect :( . Color %s was removed.", guessed_color)
 
 
 # %%
@@ -44,10 +44,88 @@ from mindstorms.operator import greater_than, greater_than_or_equal_to, less_tha
 import math
 
 import hub
+from utime import ticks_add, ticks_diff, ticks_ms, ticks_us, sleep_us
+from array import array
 
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
+# %% [markdown]
+# # Logging
+# Printing is slow on the hub, so `log` only prints the messages of the enabled levels.
+# Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops (take a look at Charlie's
+# [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %% [markdown]
 # # Initialize hub
 # Notice we won't be using the standard `MSHub`, but rather the "raw" `hub`.
@@ -61,6 +139,147 @@ print("-"*15 + " Execution started " + "-"*15 + "\n")
 # hub.status_light.on('black')
 hub.led(0, 0, 0)
 
+# %% [markdown]
+# # Define an async runtime
+# The runtime is built on `uasyncio` and runs several tasks at the same time. It provides
+# awaitable versions of the things we usually do in our programs (waiting, moving motors,
+# waiting for sensors and playing sounds), so that motions that could overlap don't have to
+# happen one after the other (take a look at Charlie's [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+print("Defining async runtime...")
+
+# MicroPython calls the asyncio module uasyncio.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+class Runtime():
+    """
+    Small runtime (on top of uasyncio) for running several tasks at the same time.
+
+    It provides awaitable versions of the (blocking) things that our programs
+    usually do: sleeping, moving motors, waiting for sensors and playing sounds.
+    Motors are the "raw" ones (e.g., hub.port.B.motor), since their
+    run_to_position doesn't block.
+    """
+    TOLERANCE = 3 # Maximum position error (in degrees) for a move to be done.
+
+    def __init__(self, start_sound=None, poll_ms=10):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        start_sound:
+            Function that starts playing a sound (without waiting for it to finish).
+            Default value is None.
+        poll_ms:
+            How often (in ms) conditions are checked while waiting.
+            Default value is 10.
+        """
+        self.start_sound = start_sound
+        self.poll_ms = poll_ms
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the runtime clock.
+        """
+        self.elapsed_us = 0
+        self.last_ticks = ticks_us()
+
+    def now(self):
+        """
+        Returns the time (in us) since the runtime clock was last reset.
+        """
+        # We accumulate the elapsed time (instead of subtracting a start time),
+        # so the ticks can wrap around as many times as they want.
+        ticks = ticks_us()
+        self.elapsed_us += ticks_diff(ticks, self.last_ticks)
+        self.last_ticks = ticks
+        return self.elapsed_us
+
+    async def sleep(self, seconds):
+        """
+        Awaitable version of wait_for_seconds.
+        """
+        await asyncio.sleep(seconds)
+
+    async def sleep_until(self, t_us):
+        """
+        Sleeps until the given time (in us since the runtime clock was last reset).
+        """
+        # Other tasks can run during most of the wait (with ms resolution)...
+        delay_us = t_us - self.now()
+        if delay_us > 1000:
+            await asyncio.sleep((delay_us // 1000) / 1000)
+
+        # ...but we wait the last bit ourselves, to be on time to the us.
+        delay_us = t_us - self.now()
+        if delay_us > 0:
+            sleep_us(delay_us)
+
+    async def wait_until(self, condition, timeout=None):
+        """
+        Waits until condition() (e.g., a sensor check) is True.
+        Returns False if it took longer than timeout (in seconds).
+        """
+        if timeout is not None:
+            deadline = self.now() + int(timeout * 1000000)
+        while not condition():
+            if timeout is not None and self.now() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_ms / 1000)
+        return True
+
+    async def run_for_degrees(self, motor, degrees, speed=75, timeout=None):
+        """
+        Awaitable version of run_for_degrees.
+        Returns False if the motor didn't get there in time (e.g., it was blocked).
+        """
+        target = motor.get()[1] + degrees
+        motor.run_to_position(target, abs(speed))
+
+        done = False
+        try:
+            done = await self.wait_until(lambda: abs(motor.get()[1] - target) <= self.TOLERANCE, timeout)
+        finally:
+            # If the move timed out (or its task was cancelled), we stop the motor.
+            if not done:
+                motor.brake()
+        return done
+
+    async def run_to_position(self, motor, position, speed=75, timeout=None):
+        """
+        Awaitable version of run_to_position (using the shortest path).
+        Returns False if the motor didn't get there in time (e.g., it was blocked).
+        """
+        degrees = (position - motor.get()[2] + 180) % 360 - 180
+        return await self.run_for_degrees(motor, degrees, speed, timeout)
+
+    async def play_sound(self, name, seconds):
+        """
+        Awaitable version of play_sound. Since we can't know when a sound
+        is over, we need to give its duration (in seconds).
+        """
+        self.start_sound(name)
+        await asyncio.sleep(seconds)
+
+    def run(self, *coroutines):
+        """
+        Runs the given coroutines at the same time (until all of them are done).
+        """
+        async def main():
+            await asyncio.gather(*coroutines)
+        asyncio.run(main())
+
+print("DONE!")
+
+# %%
+runtime = Runtime(start_sound=hub.sound.play)
+
 # %% [markdown]
 # # Initialize motors
 
@@ -71,12 +290,20 @@ motor_power = Motor('C') # Back wheels (for moving)
 
 motor_turret = Motor('B') # Turrent spinning
 
+# "Raw" motors, for the awaitable moves of the runtime.
+raw_steer = hub.port.A.motor
+raw_turret = hub.port.B.motor
+
+# %% [markdown]
+# The steering and the turret can be set to their initial position at the same time.
+
 # %%
-print("Setting motors to position 0...")
-motor_steer.run_to_position(45, speed=100)
-motor_steer.run_to_position(0, speed=100)
+async def reset_steering():
+    await runtime.run_to_position(raw_steer, 45, speed=100)
+    await runtime.run_to_position(raw_steer, 0, speed=100)
 
-motor_turret.run_to_position(0, speed=75)
+print("Setting motors to position 0...")
+runtime.run(reset_steering(), runtime.run_to_position(raw_turret, 0, speed=75))
 print("DONE!")
 
 
@@ -139,160 +366,383 @@ OBSTACLE_DISTANCE = 10 # [cm]
 
 
 # %% [markdown]
-# However, if the sensor reads no measure, it will return a `None`, which
-# in turn will generate an error (since we cannot do a comparision
-# between a `None` and something else).
-#
-# To solve this, we will define our own cuestom distance function.
-# This way, when the sensor has no reading, we will just return
-# a (simulated) very long distance (instead of returning a `None`).
-# This will allow us to safely do the comparision.
+# Instead of reading the sensor every time we check, the `DistanceService` reads it
+# at a fixed rate (every 20 ms) in the background (as another task of the runtime)
+# and gives the median of the last three samples.
+# This way, a single noisy sample won't make the AAT MS5 open fire.
+# When the sensor has no reading, it returns a `None` (which we can't compare
+# with a number). In that case, the service uses the range of the sensor (200 cm) instead.
 
 # %%
-def my_get_distance_cm():
+class DistanceService():
     """
-    Parameters
-    ----------
-    None
-        
-    Returns
-    -------
-    dist:
-        Distance value (in cm).
-        If the sensor returns a None, it returns a very large value (1000).
+    Reads the distance sensor at a fixed rate (at most once every period_ms,
+    no matter how often the program asks for the distance) and filters the
+    latest samples, so that a single noisy sample doesn't trigger anything.
     """
-    distance = distance_sensor.get_distance_cm()
-    if distance == None:
-        distance = 10000
-        
-    return distance
+
+    def __init__(self, sensor, period_ms=20, size=3, mode='median', alpha=0.5, max_cm=200):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        sensor:
+            Distance sensor (e.g., DistanceSensor('D')).
+        period_ms:
+            Sampling period (in ms).
+            Default value is 20.
+        size:
+            Number of samples of the median filter.
+            Default value is 3.
+        mode:
+            'median' or 'ema' (exponential moving average).
+            Default value is 'median'.
+        alpha:
+            Weight of the newest sample in the EMA (between 0 and 1).
+            Default value is 0.5.
+        max_cm:
+            Distance (in cm) used when the sensor doesn't see anything
+            (i.e., when it returns None).
+            Default value is 200 (the range of the sensor).
+        """
+        self.sensor = sensor
+        self.period_us = period_ms * 1000
+        self.mode = mode
+        self.alpha = alpha
+        self.max_cm = max_cm
+
+        self.samples = array('h', [max_cm] * size) # Ring buffer (in cm).
+        self.n_samples = 0
+        self.ema = max_cm
+        self.distance = max_cm
+        self.sample_ticks = None
+        self.next_ticks = 0
+        self.running = False
+
+        # [threshold, hysteresis, on_near, on_far, near]
+        self.thresholds = []
+
+    def add_threshold(self, threshold, on_near=None, on_far=None, hysteresis=3):
+        """
+        Calls on_near(distance) when the filtered distance drops below threshold,
+        and on_far(distance) when it goes back above threshold + hysteresis (in cm).
+        """
+        self.thresholds.append([threshold, hysteresis, on_near, on_far, False])
+
+    def update(self):
+        """
+        Takes a new sample if it is time to. Returns True if it did.
+        """
+        now = ticks_us()
+        if self.sample_ticks is not None and ticks_diff(now, self.next_ticks) < 0:
+            return False
+        self.sample(now)
+        return True
+
+    def sample(self, now):
+        """
+        Reads the sensor (now is the time of the read, from ticks_us())
+        and updates the filtered distance.
+        """
+        # If we missed a whole sample (e.g., because the program was busy moving),
+        # the older samples are stale. Thus, the filter starts over with this one.
+        if self.sample_ticks is not None and ticks_diff(now, self.sample_ticks) >= 2 * self.period_us:
+            self.n_samples = 0
+
+        distance = self.sensor.get_distance_cm()
+        if distance == None:
+            distance = self.max_cm
+        self.sample_ticks = now
+        # Keep the rate fixed, unless we are more than a period behind
+        # (e.g., because the program didn't ask for a while).
+        self.next_ticks = ticks_add(self.next_ticks, self.period_us)
+        if self.n_samples == 0 or ticks_diff(now, self.next_ticks) >= 0:
+            self.next_ticks = ticks_add(now, self.period_us)
+
+        self.samples[self.n_samples % len(self.samples)] = distance
+        self.n_samples += 1
+        if self.n_samples == 1:
+            self.ema = distance
+        else:
+            self.ema += self.alpha * (distance - self.ema)
+
+        if self.mode == 'ema':
+            self.distance = self.ema
+        else:
+            latest = sorted(self.samples[0:min(self.n_samples, len(self.samples))])
+            self.distance = latest[len(latest) // 2]
+
+        for threshold in self.thresholds:
+            if not threshold[4] and self.distance < threshold[0]:
+                threshold[4] = True
+                if threshold[2] is not None:
+                    threshold[2](self.distance)
+            elif threshold[4] and self.distance > threshold[0] + threshold[1]:
+                threshold[4] = False
+                if threshold[3] is not None:
+                    threshold[3](self.distance)
+
+    async def run(self):
+        """
+        Samples the sensor every period_ms in the background (as a task of the runtime)
+        until stop() is called.
+        """
+        self.running = True
+        t = runtime.now()
+        while self.running:
+            self.sample(ticks_us())
+            # Keep the rate fixed, unless we are more than a period behind
+            # (e.g., because another task blocked for a while).
+            t += self.period_us
+            if runtime.now() - t >= self.period_us:
+                t = runtime.now()
+            await runtime.sleep_until(t)
+
+    def stop(self):
+        """
+        Stops the background sampling.
+        """
+        self.running = False
+
+    def value(self):
+        """
+        Returns the filtered distance (in cm). If the service isn't sampling
+        in the background, it takes a new sample only if it is time to.
+        """
+        if not self.running:
+            self.update()
+        return self.distance
+
+    def age_ms(self):
+        """
+        Returns how old the last sample is (in ms).
+        """
+        if self.sample_ticks is None:
+            return None
+        return ticks_diff(ticks_us(), self.sample_ticks) // 1000
+
+distance_service = DistanceService(distance_sensor)
+
+# %% [markdown]
+# ## Measure the reaction latency
+# How long does it take to react to the sensor? The probe measures the time between
+# the sensor read that crossed the threshold and the first command issued in response
+# (i.e., how long the sensor reading, the checks and the prints in between take).
+# You can also measure it on your computer over many trials with
+# [`tools/reaction_benchmark.py`](https://github.com/arturomoncadatorres/lego-mindstorms/blob/main/tools/reaction_benchmark.py),
+# which is handy to check that a change didn't make the reaction slower.
+
+# %%
+class ReactionProbe():
+    """
+    Measures the reaction latency: the time between the sensor read that
+    crossed a threshold and the first actuator command issued in response.
+    """
+
+    def __init__(self, n_trials=100):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        n_trials:
+            Number of (latest) trials to keep.
+            Default value is 100.
+        """
+        self.latencies = array('i', [0] * n_trials) # Ring buffer (in us).
+        self.n_trials = 0
+        self.read_ticks = 0
+        self.trigger_ticks = None
+        self.last_trigger_ticks = None
+
+    def read(self, ticks=None):
+        """
+        Call right after every sensor read (or pass the time of the read,
+        from ticks_us(), if it happened earlier).
+        """
+        if ticks is None:
+            ticks = ticks_us()
+        self.read_ticks = ticks
+
+    def trigger(self):
+        """
+        Call when the last read crossed the threshold.
+        """
+        if self.trigger_ticks is None:
+            self.trigger_ticks = self.read_ticks
+
+    def react(self):
+        """
+        Call right before the first actuator command in response to the trigger.
+        """
+        if self.trigger_ticks is None:
+            return
+        self.latencies[self.n_trials % len(self.latencies)] = ticks_diff(ticks_us(), self.trigger_ticks)
+        self.n_trials += 1
+        self.last_trigger_ticks = self.trigger_ticks
+        self.trigger_ticks = None
+
+    def print_stats(self, bin_ms=5):
+        """
+        Prints the distribution of the reaction latency (with a histogram in bins of bin_ms).
+        """
+        n = min(self.n_trials, len(self.latencies))
+        if n == 0:
+            return
+        values = sorted(self.latencies[0:n])
+        print("Reaction latency (" + str(n) + " trials): min = " + str(values[0]) + " us; "
+              + "median = " + str(values[n // 2]) + " us; p90 = " + str(values[min(n - 1, 9 * n // 10)]) + " us; "
+              + "max = " + str(values[-1]) + " us")
+
+        bin_us = bin_ms * 1000
+        start = 0
+        while start < n:
+            low = values[start] // bin_us
+            end = start
+            while end < n and values[end] // bin_us == low:
+                end += 1
+            print("  " + str(low * bin_ms) + "-" + str((low + 1) * bin_ms) + " ms: " + "#" * (end - start) + " (" + str(end - start) + ")")
+            start = end
+
+probe = ReactionProbe()
+
+
+# %%
+def obstacle_detected():
+    """
+    Returns True if the distance sensor detects an obstacle.
+    """
+    distance = distance_service.value()
+    probe.read(distance_service.sample_ticks)
+    if log.enabled(Logger.DEBUG):
+        log.debug("Distance = %s cm (%s ms old)", distance, distance_service.age_ms(), every_ms=200)
+    detected = distance <= OBSTACLE_DISTANCE
+    if detected:
+        probe.trigger()
+    return detected
 
 
 # %% [markdown]
 # ## Patrolling
 # Now, in order to be able to stop the turret at any moment 
 # (and not until the motor has completed a whole sweep), 
-# we will use co-routines. 
+# we can't just use the (blocking) `run_for_degrees`.
 #
-# > This is a simplified version [David Lechner's trick](https://community.legoeducation.com/discuss/viewtopic/66/110), which I've used before in [Charlie's `drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True).
-# In this case, we are only controlling one motor (the turret) and we don't depend on time
-# (but rather on the motor position). Thus, we don't need a timer.
+# Instead, we let the motor do what it does best: moving to a position by itself
+# (using its own controller). Meanwhile, we only need to check two things:
+# whether it got there (to send it to the other side) and whether there is an obstacle
+# (to stop it right away). We don't need to check them all the time: if the turret
+# moves at `v` degrees per second and we check every `dt` seconds, the turret
+# will move at most `v * dt` degrees after an obstacle appears. Thus, the faster the turret
+# moves, the more often we check (so that it never moves more than `MAX_TRAVEL` degrees).
 #
-# We need to define a function for moving the turret. 
-# Pay attention to the comments, since they explain how using
-# co-routines work. It isn't very hard, but it isn't trivial either.
+# We also keep track of how much the turret goes past its target (the overshoot)
+# and how much it moves after detecting an obstacle.
 
 # %%
-def move_turret():
-
+class TurretSweep():
     """
-    Moves the AAT MS5 turrent.
-    
-    Parameters
-    ----------
-    None
-            
-    Returns
-    -------
-    None
+    Sweeps the turret from side to side (using the position moves of the motor)
+    until an obstacle is detected.
     """
-    
-    # First, we need to define the coroutine.
-    # In this case, we only need one (corresponding to the turret motor).
-    # Notice how the definition is very similar to that of a function.
-    # Coroutines also have input parameters.
-    # However, they have no "output" (i.e., return), but actually a yield.
-    def background_turret(angle):
+    DEGREES_PER_SECOND = 10 # Approximate speed of the motor (in degrees/s) for each % of speed.
+    TOLERANCE = 3 # Maximum position error (in degrees) for a move to be done.
+    MIN_POLL_MS = 2
+
+    def __init__(self, motor, angle, speed=10, max_travel=2):
         """
+        Initialization
+
         Parameters
         ----------
+        motor:
+            "Raw" motor of the turret (e.g., hub.port.B.motor).
         angle:
-            The angle at which the turret turns. 
-            In practice, this value is twice the original angle, since
+            The angle at which the turret turns (in degrees).
+            In practice, the turret moves twice this angle, since
             it moves completely from one side to the other (and not from
-            the center to one side). That is why it is passed to this 
-            function multiplied by two.
-            
-            In degrees.
-        """
-        
-        # We want to make sure counted degrees are initialized at 0.
-        motor_turret.set_degrees_counted(0)
-        
-        # Notice that we use the absolute value of the counted degrees.
-        # This is to ensure that it works on the way back (when the measured
-        # degrees would be negative).
-        curr_turret_position = math.fabs(motor_turret.get_degrees_counted())
-
-        # Here, we check if the motor has reached the desired angle.
-        while curr_turret_position < angle:
-            
-            # If you wish to see the current turret position and the target angle,
-            # uncomment the following line.
-            # print(str(curr_turret_position) + " - " +  str(angle))
-            
-            # We update the turret current position.
-            curr_turret_position = math.fabs(motor_turret.get_degrees_counted())
-            
-            # If the turret hasn't reached the desired angle, we reach this yield.
-            # yield lets the rest of the program run until we come back
-            # here again later to check if the condition was met.
-            yield
-
-
-    def turret_patrol():
-        while True:
-
-            # This is how we receive a parameter.
-            # In this case, it corresponds to the angle the motor should move.
-            angle_action = yield
-
-            # We make sure we only execute code if the received
-            # value was transmitted correctly.
-            if not angle_action == None:
-                
-                # We will start to move the turret...
-                motor_turret.start(10)
-                
-                # ...and check if its angle exceeded the maximum allowed.
-                # First we move the turret from left to right...
-                yield from background_turret(angle_action*2)
-                hub.sound.beep(150, 200, hub.sound.SOUND_SIN) # Play simple tone
-
-
-                # ...and from right to left (exactly same process, but inverted speed).
-                motor_turret.start(-10)
-                yield from background_turret(angle_action*2)
-                # hub.sound.play("/extra_files/Ping")
-                hub.sound.beep(150, 200, hub.sound.SOUND_SIN) # Play simple tone
-
-                # We assume that the movement is immediate and takes no time.
-                # This isn't completely true, but for now it works.
+            the center to one side).
+        speed:
+            Speed of the sweep (in %).
+            Default value is 10.
+        max_travel:
+            Maximum movement (in degrees) of the turret between two checks.
+            Default value is 2.
+        """
+        self.motor = motor
+        self.angle = angle
+        self.speed = speed
+        self.poll_ms = max(self.MIN_POLL_MS, 1000 * max_travel // (self.DEGREES_PER_SECOND * abs(speed)))
 
-    # Since turret_patrol() is a coroutine and uses yield
-    # (i.e., it isn't a function and thus has no return), it will NOT
-    # run here when we call it. Instead, it will just be created as a generator object.
-    # This generator will be used to run the functions one yield (i.e., step) at a time.
-    turret_generator = turret_patrol()
+        self.n_sweeps = 0
+        self.max_overshoot = 0
+        self.total_overshoot = 0
+        self.stop_travel = 0
 
-    # Now we will actually start the task.
-    # The task (turret patrolling) will be run as long as the distance sensor
-    # doesn't detect an obstacle.
-    while my_get_distance_cm() > OBSTACLE_DISTANCE:
-        
-        next(turret_generator)
-        turret_generator.send(TURRET_ANGLE)
+    async def run(self, obstacle):
+        """
+        Sweeps the turret (starting to the right of its current position)
+        until obstacle() is True. Then, it brakes the turret right away.
+        """
+        motor = self.motor
+        start = motor.get()[1]
+        targets = (start + 2 * self.angle, start)
 
-        wait_for_seconds(0.01) # Small pause between steps.
+        while True:
+            # Even sweeps go to the right and odd sweeps go back.
+            target = targets[self.n_sweeps % 2]
+            direction = 1 if self.n_sweeps % 2 == 0 else -1
+            motor.run_to_position(target, self.speed)
+
+            overshoot = -2 * self.angle
+            while True:
+                if obstacle():
+                    probe.react()
+                    motor.brake()
+                    await self.measure_stop_travel(motor.get()[1])
+                    return
+
+                speed, position = motor.get()[0:2]
+                overshoot = max(overshoot, direction * (position - target))
+                if overshoot >= -self.TOLERANCE and speed == 0:
+                    break
+                await runtime.sleep(self.poll_ms / 1000)
+
+            self.n_sweeps += 1
+            log.debug("Sweep %d: overshoot = %d degrees", self.n_sweeps, overshoot)
+            self.max_overshoot = max(self.max_overshoot, overshoot)
+            self.total_overshoot += overshoot
+            hub.sound.beep(150, 200, hub.sound.SOUND_SIN) # Play simple tone
+
+    async def measure_stop_travel(self, position):
+        """
+        Measures how much the turret moved after braking.
+        """
+        await runtime.wait_until(lambda: self.motor.get()[0] == 0, timeout=1)
+        self.stop_travel = abs(self.motor.get()[1] - position)
 
-    return None
+    def print_stats(self):
+        """
+        Prints the statistics of the sweeps.
+        """
+        print("Checks every " + str(self.poll_ms) + " ms")
+        if self.n_sweeps > 0:
+            print("Sweeps: " + str(self.n_sweeps) + "; overshoot: max = " + str(self.max_overshoot)
+                  + " degrees, mean = " + str(self.total_overshoot / self.n_sweeps) + " degrees")
+        print("Travel after detection: " + str(self.stop_travel) + " degrees")
 
 
 # %% [markdown]
 # After we have defined the turret movement, we can now make the AAT MS5 patrol until it finds those pesky Republic supporters!
+#
+# `TURRET_SPEED` is the speed of the sweep (in %) and `MAX_TRAVEL` is the maximum movement
+# of the turret (in degrees) between two checks.
 
 # %%
 TURRET_ANGLE = 40
+TURRET_SPEED = 10
+MAX_TRAVEL = 2
 
 print("Initializing turret with angle " + str(TURRET_ANGLE) + "...")
 motor_turret.set_default_speed(10)
@@ -300,7 +750,14 @@ motor_turret.run_for_degrees(-TURRET_ANGLE)
 print("DONE!")
 
 print("Starting patrolling...")
-move_turret()
+turret_sweep = TurretSweep(raw_turret, TURRET_ANGLE, speed=TURRET_SPEED, max_travel=MAX_TRAVEL)
+
+async def patrol():
+    await turret_sweep.run(obstacle_detected)
+    distance_service.stop()
+
+runtime.run(distance_service.run(), patrol())
+turret_sweep.print_stats()
 print("DONE!")
 
 # %% [markdown]
@@ -311,10 +768,79 @@ print("Enemy detected! Attack!")
 motor_power.stop() # Stop the movement
 motor_turret.run_to_position(0, speed=75) # Center the turret
 
+probe.print_stats()
+
 # %% [markdown]
 # Then, it will fire three blasters. Each blaster will come with a sound and an
 # animation of the blaster moving in the hub.
 #
+# Instead of building the image of every frame and waiting between them (which would
+# block the program during the whole animation), we will use an `AnimationPlayer`.
+# It builds the images only once and shows each frame when it is due, so the program
+# can keep doing other things while the animation plays.
+
+# %%
+class AnimationPlayer():
+    """
+    Plays an animation on the hub display without blocking the program.
+    The images of the frames are built only once, and update() shows
+    the next frame when it is due (call it as often as possible).
+    """
+
+    def __init__(self, frames, frame_ms=50):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        frames:
+            List of frames (as strings for hub.Image, e.g., '00000:00500:...').
+        frame_ms:
+            Duration of each frame (in ms).
+            Default value is 50.
+        """
+        self.images = [hub.Image(frame) for frame in frames]
+        self.frame_us = frame_ms * 1000
+        self.frame = None # Index of the current frame (None if not playing).
+        self.next_ticks = 0
+
+    def play(self):
+        """
+        Starts (or restarts) the animation.
+        """
+        self.frame = 0
+        self.next_ticks = ticks_add(ticks_us(), self.frame_us)
+        hub.display.show(self.images[0])
+
+    def is_playing(self):
+        return self.frame is not None
+
+    def update(self):
+        """
+        Shows the next frame if it is due. Returns True while the animation is playing.
+        """
+        if self.frame is None:
+            return False
+        now = ticks_us()
+        if ticks_diff(now, self.next_ticks) < 0:
+            return True
+
+        # If we are late, skip frames (so that the animation keeps its duration),
+        # but always show the last one.
+        shown = self.frame
+        while ticks_diff(now, self.next_ticks) >= 0:
+            self.frame += 1
+            self.next_ticks = ticks_add(self.next_ticks, self.frame_us)
+        if self.frame >= len(self.images):
+            if shown < len(self.images) - 1:
+                hub.display.show(self.images[-1])
+            self.frame = None
+            return False
+        hub.display.show(self.images[self.frame])
+        return True
+
+
+# %% [markdown]
 # First, lets define the frames of the animation.
 
 # %%
@@ -330,9 +856,10 @@ frames = ['00000:00000:00000:00000:00000',
 '00000:00000:00000:00000:00500',
 '00000:00000:00000:00000:00000']
 
-n_frames = len(frames)
 t_pause = 0.05 # Pause between frames (in seconds)
 
+blaster = AnimationPlayer(frames, frame_ms=int(t_pause * 1000))
+
 print("DONE!")
 
 
@@ -344,18 +871,21 @@ print("Firing blasters...")
 
 n_blasters = 3
 
-for ii in range(0, n_blasters):
+async def fire_blasters(n_blasters):
+    for ii in range(0, n_blasters):
+
+        # Play blaster sound.
+        hub.sound.play("/extra_files/Laser")
 
-    # Play blaster sound.
-    hub.sound.play("/extra_files/Laser")
+        # Display blaster animation.
+        # Other tasks of the runtime can run while we wait for the next frame.
+        blaster.play()
+        while blaster.update():
+            await runtime.sleep_until(runtime.now() + ticks_diff(blaster.next_ticks, ticks_us()))
 
-    # Display blaster animation.
-    for ii in range(0, n_frames):
-        img = hub.Image(frames[ii])
-        hub.display.show(img)
-        wait_for_seconds(t_pause)
+        await runtime.sleep(0.5)
 
-    wait_for_seconds(0.5)
+runtime.run(fire_blasters(n_blasters))
 
 print("DONE!")
 
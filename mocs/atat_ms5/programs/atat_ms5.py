@@ -42,11 +42,88 @@
 import hub
 import utime
 import math
+from array import array
 
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
 
+# %% [markdown]
+# # Logging
+# Printing is slow on the hub, so `log` only prints the messages of the enabled levels.
+# Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops (take a look at Charlie's
+# [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = utime.ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and utime.ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %% [markdown]
 # # Anton's MINDSTORMS motor synchronization
 # We will be using [Anton's MINDSTORMS](https://antonsmindstorms.com/) technique for the motor synchronization. It is made of three main components:
@@ -158,9 +235,158 @@ class AMHTimer():
             self.start()
 
 
+# %% [markdown]
+# ### Fixed-point timer
+# `AMHTimer` does its calculations with floats every time we read it, which is once per control cycle.
+# Moreover, it squares the time elapsed since it was (re)started. In long runs, this number grows and grows,
+# and floats (which in the hub only have single precision) start losing precision.
+#
+# `AMHFixedPointTimer` works the same, but it only uses integers. The rate and the acceleration are stored as
+# [fixed-point](https://en.wikipedia.org/wiki/Fixed-point_arithmetic) numbers (i.e., integers that implicitly are divided by 256),
+# and the time is kept in steps of 1/256000 of a tick. Thus, any rate that is a whole number of ticks/s (like the default 1000)
+# is represented exactly, and the timer doesn't drift, no matter how slow it runs.
+# Moreover, roughly every second it moves its starting point (epoch) to the current time, keeping the fraction of a tick that was left.
+# This way, the numbers it works with always stay small (and fast), the hub's tick counter can overflow without problem,
+# and it stays accurate no matter how many hours your robot runs.
+
+# %%
+class AMHFixedPointTimer():
+    """
+    Integer (fixed-point) version of AMHTimer.
+    It has the same interface (time, rate, acceleration,
+    pause, start, reset, reverse...), and rate means the same
+    (except that it doesn't keep changing while the timer is paused).
+
+    The rate is stored in 1/256 ticks/s and the time in steps of
+    1/256000 ticks (i.e., 1/256 ticks/s during 1 ms). Thus, every
+    rate that is a multiple of 1/256 ticks/s (e.g., any integer rate)
+    is exact: the timer doesn't drift and rate gives back the value
+    that was set. Other rates are rounded to the nearest 1/256 ticks/s.
+    The acceleration is stored in 1/256 ticks/s^2. Since its effect on
+    the rate is rounded down (to 1/256000 ticks/ms) at every rebase,
+    an accelerating timer can be off by up to 1/256 ticks/s.
+
+    The epoch is rebased at least every REBASE_MS, so the elapsed
+    time (and all the intermediate products) stay small and the timer
+    keeps working when utime.ticks_ms() wraps around.
+
+    Usage:
+        my_timer = AMHFixedPointTimer()
+        now = my_timer.time  # Read the time
+    """
+    REBASE_MS = 1000
+    SCALE = 256 # Fixed-point steps per tick/s (and per tick/s^2)
+    ONE = 256000 # Fixed-point steps of the time per tick (SCALE * 1000 ms)
+
+    def __init__(self, rate=1000, acceleration=0):
+        self.running = True
+        self.reset_at_next_start = False
+        self.base_time = 0 # Integer part of the time at start_time
+        self.__fraction = 0 # Fractional part of the time at start_time (in 1/ONE ticks)
+        self.__speed = int(round(rate * self.SCALE)) # 1/SCALE ticks/s (i.e., 1/ONE ticks per ms)
+        self.__start_speed = self.__speed # Speed at the last start (like the speed factor of AMHTimer)
+        self.__accel = int(round(acceleration * self.SCALE)) # 1/SCALE ticks/s^2
+        self.start_time = utime.ticks_ms()
+
+    def __elapsed_fraction(self, elapsed):
+        # Time (in 1/ONE ticks) since start_time (plus the fraction left by the last rebase)
+        value = self.__fraction + self.__speed * elapsed
+        if self.__accel:
+            value += self.__accel * elapsed * elapsed // 1000
+        return value
+
+    def __rebase(self, elapsed):
+        # Move start_time forward by elapsed without changing the time
+        value = self.__elapsed_fraction(elapsed)
+        self.base_time += value // self.ONE
+        self.__fraction = value % self.ONE
+        if self.__accel:
+            self.__speed += 2 * self.__accel * elapsed // 1000
+        self.start_time = utime.ticks_add(self.start_time, elapsed)
+
+    @property
+    def time(self):
+        if self.running:
+            elapsed = utime.ticks_diff(utime.ticks_ms(), self.start_time)
+            if elapsed >= self.REBASE_MS:
+                self.__rebase(elapsed)
+                elapsed = 0
+            return self.base_time + self.__elapsed_fraction(elapsed) // self.ONE
+        else:
+            return self.base_time
+
+    @time.setter
+    def time(self, setting):
+        self.base_time = int(setting)
+        self.__fraction = 0
+        self.start_time = utime.ticks_ms()
+
+    def pause(self):
+        if self.running:
+            self.__rebase(utime.ticks_diff(utime.ticks_ms(), self.start_time))
+            self.running = False
+
+    def stop(self):
+        self.pause()
+
+    def start(self):
+        if not self.running:
+            # Like AMHTimer, the acceleration starts over from the rate at the last start.
+            self.__speed = self.__start_speed
+            self.start_time = utime.ticks_ms()
+            self.running = True
+
+    def resume(self):
+        self.start()
+
+    def reset(self):
+        self.time = 0
+
+    def reverse(self):
+        self.rate *= -1
+
+    @property
+    def rate(self):
+        speed = self.__speed
+        if self.running and self.__accel:
+            elapsed = utime.ticks_diff(utime.ticks_ms(), self.start_time)
+            speed += 2 * self.__accel * elapsed // 1000
+        # Same as AMHTimer (rate at the last start + acceleration * time since then),
+        # which is the mean of the speed at the last start and the current one.
+        return (self.__start_speed + speed) / (2 * self.SCALE)
+
+    @rate.setter
+    def rate(self, setting):
+        speed = int(round(setting * self.SCALE))
+        if self.__start_speed != speed:
+            if self.running:
+                self.pause()
+            self.__start_speed = speed
+            self.start()
+
+    @property
+    def acceleration(self):
+        return self.__accel / self.SCALE
+
+    @acceleration.setter
+    def acceleration(self, setting):
+        accel = int(round(setting * self.SCALE))
+        if self.__accel != accel:
+            speed = int(round(self.rate * self.SCALE))
+            if self.running:
+                self.pause()
+            self.__start_speed = speed
+            self.__accel = accel
+            self.start()
+
+
 # %% [markdown]
 # ## Motor animation mechanism
 # This is where the magic happens. Here, we define the central mechanism that actually animates the robot's motors. Similarly to the previous case, it is probably better if you leave this part untouched.
+#
+# I did make a couple of small changes to Anton's original code. First, every time the motor state was needed, it called `motor.get()` and kept only one of the values (e.g., the position). Each of those calls is a round-trip to the motor port, and some of them even built a new list on every pass. Now, the state of all motors (speed, position, absolute position and pwm) is read only once per control cycle into preallocated arrays, which are shared by everything that needs them during that cycle.
+#
+# Second, `shortest_path_reset` (which brings the motors to their starting position before the control loop starts) used to check the motors in a `while True` loop without any pause until all of them stopped. This kept the hub completely busy and, if a motor got stuck, it would wait forever. Now, it checks the motors every few milliseconds (sleeping in between) and gives up after a timeout. It also stops any motor that doesn't move anymore (i.e., that stalled). It returns which motors didn't make it, so we can do something about it. If you want to do other things while the motors settle, you can step the `settle` generator yourself.
 
 # %%
 class Mechanism():
@@ -179,6 +405,15 @@ class Mechanism():
         ramp_pwm: int, a number to limit maximum pwm per tick when starting. 0.5 is a good value for a slow ramp.
         Kp: float, proportional feedback factor for motor power.
 
+    Attributes:
+        speeds, positions, absolute_positions, pwms: arrays with the state of
+        each motor, as read by read_motor_states() at the beginning of each
+        control cycle. Everything that needs the motor state during that cycle
+        should use them instead of calling motor.get() again.
+        targets, powers: arrays with the target position and the pwm given
+        to each motor in the last control cycle (only filled while the
+        telemetry is enabled, see enable_telemetry()).
+
     Returns:
         None.
 
@@ -194,13 +429,40 @@ class Mechanism():
         self.motor_functions = motor_functions
         self.ramp_pwm = ramp_pwm
         self.Kp = Kp
+
+        # Motor state buffers, allocated only once.
+        n_motors = len(self.motors)
+        self.speeds = array('i', [0] * n_motors)
+        self.positions = array('i', [0] * n_motors)
+        self.absolute_positions = array('i', [0] * n_motors)
+        self.pwms = array('i', [0] * n_motors)
+        self.targets = array('i', [0] * n_motors)
+        self.powers = array('i', [0] * n_motors)
+        self.telemetry = None
+
         if reset_zero:
             self.relative_position_reset()
 
+    def read_motor_states(self):
+        # Read the state of all motors (one motor.get() per motor)
+        # into the state buffers
+        speeds = self.speeds
+        positions = self.positions
+        absolute_positions = self.absolute_positions
+        pwms = self.pwms
+        ii = 0
+        for motor in self.motors:
+            state = motor.get()
+            speeds[ii] = state[0]
+            positions[ii] = state[1]
+            absolute_positions[ii] = state[2]
+            pwms[ii] = state[3]
+            ii += 1
+
     def relative_position_reset(self):
         # Set degrees counted of all motors according to absolute 0
-        for motor in self.motors:
-            absolute_position = motor.get()[2]
+        self.read_motor_states()
+        for motor, absolute_position in zip(self.motors, self.absolute_positions):
             if absolute_position > 180:
                 absolute_position -= 360
             motor.preset(absolute_position)
@@ -213,9 +475,11 @@ class Mechanism():
 
     def update_motor_pwms(self, ticks):
         # Proportional controller toward desired motor positions at ticks
-        for motor, motor_function in zip(self.motors, self.motor_functions):
+        self.read_motor_states()
+        recording = self.telemetry is not None
+        ii = 0
+        for motor, motor_function, current_position in zip(self.motors, self.motor_functions, self.positions):
             target_position = motor_function(ticks)
-            current_position = motor.get()[1]
             power = self.float_to_motorpower((target_position-current_position)* self.Kp)
             
             if self.ramp_pwm < 100:
@@ -227,17 +491,89 @@ class Mechanism():
                     power = min(power, max_power)
 
             motor.pwm(power)
+            if recording:
+                self.targets[ii] = int(target_position)
+                self.powers[ii] = power
+            ii += 1
+
+        if recording:
+            self.record_telemetry(ticks)
+
+    def enable_telemetry(self, n_records=1000):
+        # Start recording ticks, target, position and pwm of every motor
+        # in each control cycle. Only the last n_records cycles are kept.
+        # All memory is allocated here, so recording allocates nothing.
+        self.telemetry_record_size = 1 + 3 * len(self.motors)
+        self.telemetry = array('i', [0] * (n_records * self.telemetry_record_size))
+        self.telemetry_index = 0
+        self.telemetry_count = 0
+
+    def disable_telemetry(self):
+        self.telemetry = None
 
-    def shortest_path_reset(self, ticks=0, speed=20):
-        # Get motors in position smoothly before starting the control loop
+    def record_telemetry(self, ticks):
+        # Write one record (ticks, and target, position and pwm per motor)
+        # in the ring buffer, overwriting the oldest one when it is full
+        telemetry = self.telemetry
+        index = self.telemetry_index
+        telemetry[index] = ticks
+        index += 1
+        for ii in range(len(self.motors)):
+            telemetry[index] = self.targets[ii]
+            telemetry[index + 1] = self.positions[ii]
+            telemetry[index + 2] = self.powers[ii]
+            index += 3
+        if index >= len(telemetry):
+            index = 0
+        self.telemetry_index = index
+        self.telemetry_count += 1
+
+    def dump_telemetry(self, filename=None):
+        # Write the recorded cycles (oldest first).
+        # With a filename, the raw buffer is written to the hub in one go
+        # (after a header with the number of motors and records). Use
+        # tools/telemetry_reader.py on your computer to read it.
+        # Without a filename, one line per cycle is printed in the console.
+        if self.telemetry is None:
+            return
+        record_size = self.telemetry_record_size
+        n_records = min(self.telemetry_count, len(self.telemetry) // record_size)
+        if self.telemetry_count > n_records:
+            # The buffer wrapped around, so the oldest record is the next one to be overwritten.
+            start = self.telemetry_index
+        else:
+            start = 0
+        buffer = memoryview(self.telemetry)
+
+        if filename is not None:
+            with open(filename, 'wb') as f:
+                f.write(array('i', [len(self.motors), n_records]))
+                if start:
+                    f.write(buffer[start:])
+                    f.write(buffer[:start])
+                else:
+                    f.write(buffer[:n_records * record_size])
+            return
+
+        print("ticks" + "".join([", target_" + str(ii) + ", position_" + str(ii) + ", pwm_" + str(ii) for ii in range(len(self.motors))]))
+        index = start
+        for _ in range(n_records):
+            print(", ".join([str(value) for value in self.telemetry[index:index + record_size]]))
+            index += record_size
+            if index >= len(self.telemetry):
+                index = 0
+
+    def shortest_path_reset(self, ticks=0, speed=20, timeout_ms=5000):
+        # Get motors in position smoothly before starting the control loop.
+        # Returns the motors that didn't get there (see wait_until_settled)
 
         # Reset internal tacho to range -180,180
         self.relative_position_reset()
 
         # Run all motors to a ticks position with shortest path
-        for motor, motor_function in zip(self.motors, self.motor_functions):
+        self.read_motor_states()
+        for motor, motor_function, current_position in zip(self.motors, self.motor_functions, self.positions):
             target_position = int(motor_function(ticks))
-            current_position = motor.get()[1]
             
             # Reset internal tacho so next move is shortest path
             if target_position - current_position > 180:
@@ -251,18 +587,334 @@ class Mechanism():
         # Give the motors time to spin up
         utime.sleep_ms(50)
         
-        # Check all motors pwms until all maneuvers have ended
+        # Wait until all maneuvers have ended
+        return self.wait_until_settled(timeout_ms=timeout_ms)
+
+    def settle(self, timeout_ms=5000, stall_ms=500, stall_degrees=2):
+        # Generator that checks once per step whether the motors finished
+        # their maneuvers (i.e., their pwm went back to 0).
+        # A motor that doesn't move at least stall_degrees in stall_ms is
+        # considered stalled and is stopped. When timeout_ms have passed,
+        # the remaining motors are stopped too.
+        # When it finishes, self.unsettled contains (motor index, reason)
+        # for every motor that didn't settle.
+        n_motors = len(self.motors)
+        self.read_motor_states()
+        start = utime.ticks_ms()
+        pending = [True] * n_motors
+        last_positions = array('i', self.positions)
+        last_moved = [start] * n_motors
+        self.unsettled = []
         while True:
-            pwms = []
-            for motor in self.motors:
-                pwms += [motor.get()[3]]
-            if not any(pwms): break
-        
+            now = utime.ticks_ms()
+            waiting = False
+            for ii in range(n_motors):
+                if not pending[ii]:
+                    continue
+                if not self.pwms[ii]:
+                    pending[ii] = False
+                elif abs(self.positions[ii] - last_positions[ii]) >= stall_degrees:
+                    last_positions[ii] = self.positions[ii]
+                    last_moved[ii] = now
+                    waiting = True
+                elif utime.ticks_diff(now, last_moved[ii]) >= stall_ms:
+                    self.motors[ii].pwm(0)
+                    pending[ii] = False
+                    self.unsettled.append((ii, 'stalled'))
+                else:
+                    waiting = True
+
+            if not waiting:
+                return
+
+            if utime.ticks_diff(now, start) >= timeout_ms:
+                for ii in range(n_motors):
+                    if pending[ii]:
+                        self.motors[ii].pwm(0)
+                        self.unsettled.append((ii, 'timeout'))
+                return
+
+            yield
+            self.read_motor_states()
+
+    def wait_until_settled(self, timeout_ms=5000, poll_ms=20, stall_ms=500, stall_degrees=2):
+        # Check the motors every poll_ms (sleeping in between) until they
+        # all settled, stalled or timeout_ms have passed.
+        # Returns a list of (motor index, reason) of the motors that didn't settle
+        # (empty if everything went well)
+        for _ in self.settle(timeout_ms, stall_ms, stall_degrees):
+            utime.sleep_ms(poll_ms)
+        return self.unsettled
+
     def stop(self):
         for motor in self.motors:
             motor.pwm(0)
 
 
+# %% [markdown]
+# ## Feed-forward and PID control
+# `Mechanism` uses a purely proportional controller: the motor power is just the difference between where the motor should be and where it is, multiplied by `Kp`.
+# This means that the motor needs to be *behind* its target to move at all. The faster the target moves, the further behind the motor will be.
+# For the AT-AT MS5, if we make the period `T` shorter (i.e., make it walk faster), the legs lag more and more, they get out of sync, and the AT-AT stumbles.
+#
+# `PIDMechanism` is a drop-in replacement of `Mechanism` that adds a few things to it:
+#
+# * **Velocity feed-forward**: since we know the metafunction, we also know how fast the target is moving. We can calculate that and give the motor the corresponding power right away, instead of waiting for an error to build up. `Kff` tells how much power to give per degree/s.
+# * **Integral and derivative terms** (`Ki` and `Kd`). The integral term has anti-windup: it is limited to `i_limit` and it stops integrating when the motor power is already saturated.
+# * A **deadband**: errors smaller than `deadband` degrees are ignored, so the motors don't keep twitching around their target.
+#
+# All gains can be a single number (same for all motors) or a list with one value per motor.
+
+# %%
+class PIDMechanism(Mechanism):
+    """
+    Mechanism with velocity feed-forward and a PID controller.
+
+    Args:
+        motors, motor_functions, reset_zero, ramp_pwm: see Mechanism
+
+    Optional Args:
+        Kp: float or list, proportional gain (pwm per degree).
+        Ki: float or list, integral gain (pwm per degree*s).
+        Kd: float or list, derivative gain (pwm per degree/s).
+        Kff: float or list, velocity feed-forward gain (pwm per degree/s).
+        i_limit: float, maximum absolute pwm of the integral term.
+        deadband: float, errors smaller than this (in degrees) are ignored.
+        ff_ticks: int, ticks ahead used to estimate the target velocity.
+
+    Usage:
+        my_mechanism = PIDMechanism([Motor('A'), Motor('B')], [func_a, func_b], Ki=0.5, Kff=[0.1, 0.12])
+        timer = AMHTimer()
+        while True:
+            my_mechanism.update_motor_pwms(timer.time)
+    """
+    def __init__(self, motors, motor_functions, reset_zero=True, ramp_pwm=100,
+                 Kp=1.2, Ki=0, Kd=0, Kff=0.1, i_limit=30, deadband=0, ff_ticks=10):
+        super().__init__(motors, motor_functions, reset_zero=reset_zero, ramp_pwm=ramp_pwm, Kp=Kp)
+        n_motors = len(self.motors)
+        self.Kps = self.per_motor(Kp, n_motors)
+        self.Kis = self.per_motor(Ki, n_motors)
+        self.Kds = self.per_motor(Kd, n_motors)
+        self.Kffs = self.per_motor(Kff, n_motors)
+        self.i_limit = i_limit
+        self.deadband = deadband
+        self.ff_ticks = ff_ticks
+        self.integrals = array('f', [0] * n_motors)
+        self.previous_errors = array('f', [0] * n_motors)
+        self.previous_ticks = None
+
+    @staticmethod
+    def per_motor(gain, n_motors):
+        # Turn a gain into a list with one value per motor
+        if isinstance(gain, (list, tuple)):
+            if len(gain) != n_motors:
+                raise ValueError("there should be one gain per motor")
+            return list(gain)
+        return [gain] * n_motors
+
+    def reset_controller(self):
+        # Forget the integral and derivative history
+        for ii in range(len(self.motors)):
+            self.integrals[ii] = 0
+            self.previous_errors[ii] = 0
+        self.previous_ticks = None
+
+    def update_motor_pwms(self, ticks):
+        # Feed-forward + PID controller toward desired motor positions at ticks
+        self.read_motor_states()
+
+        # Time (in ticks) since the previous update. We skip the I and D terms
+        # in the first update and whenever the timer doesn't move forward.
+        if self.previous_ticks is None:
+            dt = 0
+        else:
+            dt = ticks - self.previous_ticks
+        self.previous_ticks = ticks
+
+        recording = self.telemetry is not None
+        positions = self.positions
+        integrals = self.integrals
+        previous_errors = self.previous_errors
+        i_limit = self.i_limit
+        deadband = self.deadband
+        ff_ticks = self.ff_ticks
+        for ii in range(len(self.motors)):
+            motor_function = self.motor_functions[ii]
+            target_position = motor_function(ticks)
+
+            error = target_position - positions[ii]
+            if -deadband < error < deadband:
+                error = 0
+
+            # Velocity of the target (in degrees/s)
+            target_velocity = (motor_function(ticks + ff_ticks) - target_position) * 1000 / ff_ticks
+            output = self.Kps[ii] * error + self.Kffs[ii] * target_velocity
+
+            if dt > 0:
+                output += self.Kds[ii] * (error - previous_errors[ii]) * 1000 / dt
+
+                # Anti-windup: don't integrate further if the output is
+                # already saturated in the direction of the error.
+                integral = integrals[ii]
+                saturated = (output + integral >= 100 and error > 0) or (output + integral <= -100 and error < 0)
+                if not saturated:
+                    integral += self.Kis[ii] * error * dt / 1000
+                    integral = min(max(integral, -i_limit), i_limit)
+                    integrals[ii] = integral
+            previous_errors[ii] = error
+
+            power = self.float_to_motorpower(output + integrals[ii])
+
+            if self.ramp_pwm < 100:
+                # Limit pwm for a smooth start
+                max_power = int(self.ramp_pwm*(abs(ticks)))
+                if power < 0:
+                    power = max(power, -max_power)
+                else:
+                    power = min(power, max_power)
+
+            self.motors[ii].pwm(power)
+            if recording:
+                self.targets[ii] = int(target_position)
+                self.powers[ii] = power
+
+        if recording:
+            self.record_telemetry(ticks)
+
+
+# %% [markdown]
+# ## Fixed-rate control loop
+# Anton's usage example simply calls `update_motor_pwms` inside a `while True` as fast as the hub can.
+# That works, but it has a catch: how often the motors get updated depends on whatever else the hub is doing.
+# A different hub, a new firmware version, or just an extra line of code in the loop will change the rate of the controller.
+# Then, a value of `Kp` that worked nicely before might not anymore.
+#
+# To avoid that, we will run the loop at a fixed rate instead. `ControlLoop` calculates the moment
+# each cycle should start as an absolute deadline (using `utime.ticks_us`) and sleeps until then.
+# Since the deadlines are absolute, small delays don't accumulate over time.
+#
+# It also keeps a few statistics of how well it did: how many cycles took longer than the target
+# period (overruns), the minimum, mean and maximum period, and the jitter (how far each period was from the target).
+# They are just a handful of numbers, so they don't grow with the duration of the run.
+
+# %%
+class ControlLoop():
+    """
+    Runs Mechanism.update_motor_pwms at a fixed rate.
+
+    Parameters
+    ----------
+    mechanism: Mechanism
+        Mechanism to update.
+
+    timer: AMHTimer
+        Timer that gives the ticks passed to the mechanism.
+
+    period_us: integer
+        Target duration of each control cycle (in us).
+        Default value is 5000 (i.e., 200 Hz).
+
+    Usage:
+        control_loop = ControlLoop(my_mechanism, AMHTimer(), period_us=5000)
+        control_loop.run(duration_ms=10000)
+        control_loop.print_stats()
+    """
+    def __init__(self, mechanism, timer, period_us=5000):
+        self.mechanism = mechanism
+        self.timer = timer
+        self.period_us = int(period_us)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.min_period_us = 0
+        self.max_period_us = 0
+        self.total_period_us = 0
+        self.max_jitter_us = 0
+        self.total_jitter_us = 0
+
+    @property
+    def mean_period_us(self):
+        if self.cycles < 2:
+            return 0
+        return self.total_period_us // (self.cycles - 1)
+
+    @property
+    def mean_jitter_us(self):
+        if self.cycles < 2:
+            return 0
+        return self.total_jitter_us // (self.cycles - 1)
+
+    def run(self, duration_ms=None):
+        """
+        Runs the control loop.
+
+        Parameters
+        ----------
+        duration_ms: integer
+            Duration of the run (in ms). If None, it runs forever.
+            Default value is None.
+
+        Returns
+        -------
+        None
+        """
+        # Local variables are faster than attributes and globals.
+        update_motor_pwms = self.mechanism.update_motor_pwms
+        timer = self.timer
+        period_us = self.period_us
+        ticks_us = utime.ticks_us
+        ticks_diff = utime.ticks_diff
+        ticks_add = utime.ticks_add
+        sleep_us = utime.sleep_us
+
+        start = ticks_us()
+        deadline = start
+        previous = start
+        first_cycle = True
+        while duration_ms is None or ticks_diff(previous, start) < duration_ms * 1000:
+            now = ticks_us()
+            if first_cycle:
+                first_cycle = False
+            else:
+                # Keep statistics of the actual period.
+                period = ticks_diff(now, previous)
+                jitter = period - period_us
+                if jitter < 0:
+                    jitter = -jitter
+                if self.cycles == 1 or period < self.min_period_us:
+                    self.min_period_us = period
+                if period > self.max_period_us:
+                    self.max_period_us = period
+                if jitter > self.max_jitter_us:
+                    self.max_jitter_us = jitter
+                self.total_period_us += period
+                self.total_jitter_us += jitter
+            previous = now
+            self.cycles += 1
+
+            update_motor_pwms(timer.time)
+
+            # Sleep until the start of the next cycle.
+            deadline = ticks_add(deadline, period_us)
+            remaining = ticks_diff(deadline, ticks_us())
+            if remaining > 0:
+                sleep_us(remaining)
+            else:
+                # We are late. Instead of trying to catch up
+                # (which would make the following cycles too short),
+                # we start counting again from now.
+                self.overruns += 1
+                deadline = ticks_us()
+                log.debug("Control cycle overrun (%d us late)", -remaining, every_ms=1000)
+
+    def print_stats(self):
+        print("Cycles: " + str(self.cycles) + "; overruns: " + str(self.overruns))
+        print("Period [us]: min = " + str(self.min_period_us) + "; mean = " + str(self.mean_period_us) + "; max = " + str(self.max_period_us))
+        print("Jitter [us]: mean = " + str(self.mean_jitter_us) + "; max = " + str(self.max_jitter_us))
+
+
 # %% [markdown]
 # # Metafunction definition
 # This is where I would like to spend some time, since this is key for customizing this approach to the AT-AT MS5. We need to define the movement of the motors as mathematical functions that describe them. Let's take this *piano piano*. 
@@ -416,6 +1068,120 @@ def atat_walk(factor=1, period=4000, t_shift=0):
     return function
 
 
+# %% [markdown]
+# ## Compiling the metafunction into a lookup table
+# `atat_walk` is great for understanding what is going on. However, remember that `Mechanism`
+# calls the motor function of *every* leg on *every* pass of the control loop. Each call does
+# a modulus, a floor division, a comparison, and a few float multiplications and divisions.
+# The hub isn't particularly fast with floats (and each result is a new object in memory),
+# so all of this eats into how often we can update the motors.
+#
+# Luckily, there is no need to calculate all of that again and again. The movement repeats
+# itself every period. Moreover, after each period, the motor position just grew by a fixed
+# amount (360 degrees for `atat_walk`). Thus, we can evaluate the metafunction *once* when
+# the program starts, store one period of it in a compact table of integers (an
+# [`array`](https://docs.micropython.org/en/latest/library/array.html) of type `'h'`, which uses
+# only 2 bytes per value), and from then on just look values up.
+#
+# Since the four legs follow exactly the same pattern (only mirrored and shifted in time),
+# a single table is enough for all of them. Each leg only needs its own `factor` and `t_shift`.
+#
+# Looking a value up requires only integer operations. We also interpolate linearly between
+# two consecutive samples, so for a piecewise linear function like `atat_walk` the result
+# is (up to rounding) exactly the same as evaluating the original function.
+
+# %%
+class GaitTable():
+    """
+    Precompiled version of a periodic metafunction.
+
+    The metafunction is sampled once over a single period. Its value is
+    stored (relative to its value at 0) in an integer array. The increment
+    after a complete period (e.g., 360 degrees for atat_walk) is stored too,
+    so that motor counts keep growing past one period.
+
+    Parameters
+    ----------
+    function: function
+        Metafunction to compile (e.g., atat_walk(1, period=T)).
+        It should satisfy function(t + period) == function(t) + drift.
+
+    period: integer
+        Period of the metafunction (in ms).
+
+    resolution: integer
+        Time between two samples of the table (in ms).
+        period needs to be a multiple of it.
+        Default value is 5.
+
+    Usage:
+        gait = GaitTable(atat_walk(1, period=4000), 4000)
+        motor_function = gait.function(factor=-1, t_shift=1000)
+    """
+    def __init__(self, function, period, resolution=5):
+        period = int(period)
+        resolution = int(resolution)
+        if resolution <= 0 or period % resolution:
+            raise ValueError("period must be a multiple of resolution")
+
+        n_samples = period // resolution
+        origin = function(0)
+
+        # One extra sample at the end (the value after a full period)
+        # allows interpolating within the last segment without wrapping.
+        self.table = array('h', [0] * (n_samples + 1))
+        for ii in range(n_samples + 1):
+            value = round(function(ii * resolution) - origin)
+            if not -32768 <= value <= 32767:
+                raise ValueError("metafunction values don't fit in the table")
+            self.table[ii] = value
+
+        self.period = period
+        self.resolution = resolution
+        self.origin = int(round(origin))
+        self.drift = self.table[n_samples]
+
+    def function(self, factor=1, t_shift=0):
+        """
+        Returns a motor function that looks up its values in the table.
+
+        Parameters
+        ----------
+        factor: integer
+            Scaling factor (use +1 or -1 to define the rotation direction).
+            Default value is 1.
+
+        t_shift: integer
+            Shift in time (i.e., across the x axis) given in ms.
+            Default value is 0.
+
+        Returns
+        -------
+        function: function
+            Function of the ticks (an integer, in ms) that returns the motor position.
+        """
+        # Copy everything to local variables. Reading them inside the
+        # function is faster than looking up attributes of self.
+        table = self.table
+        period = self.period
+        resolution = self.resolution
+        origin = self.origin
+        drift = self.drift
+        factor = int(factor)
+        t_shift = int(t_shift)
+
+        def function(ticks):
+            ticks = ticks + t_shift
+            cycles = ticks // period
+            phase = ticks - cycles * period
+            index = phase // resolution
+            low = table[index]
+            value = low + (table[index + 1] - low) * (phase - index * resolution) // resolution
+            return factor * (value + cycles * drift + origin)
+
+        return function
+
+
 # %% [markdown]
 # # Defining movement parameters
 # That was the most ellaborate part. From here on, it is quite simple, actually. We just need to define a few things. First, let's define the period $T$. In my experience, a value of 4000 (ms) works great (plus it made things very easy when debugging, since we are talking about 4 legs and 4 motors).
@@ -445,33 +1211,108 @@ motor_b_function = atat_walk(-1, period=T, t_shift=3*T/4)
 motor_e_function = atat_walk(1, period=T, t_shift=T/2)
 motor_a_function = atat_walk(1, period=T, t_shift=T/4)
 
+# %% [markdown]
+# The functions above work perfectly fine. However, as explained earlier, we can make the
+# control loop considerably lighter by compiling the walking pattern into a `GaitTable` only once.
+# Then, we get the function of each leg from it using exactly the same factors and shifts.
+#
+# If you want to use the original metafunctions instead (e.g., while you are experimenting
+# with a new walking pattern), just skip this cell.
+
+# %%
+atat_gait = GaitTable(atat_walk(1, period=T), period=T)
+
+motor_f_function = atat_gait.function(-1, t_shift=0)
+motor_b_function = atat_gait.function(-1, t_shift=3*T//4)
+motor_e_function = atat_gait.function(1, t_shift=T//2)
+motor_a_function = atat_gait.function(1, t_shift=T//4)
+
 # %% [markdown]
 # # Let the AT-AT MS5 walk!
-# The last part is very straightforward. We just have to create a `Mechanism`, an `AMHTimer`, and make it run!
+# The last part is very straightforward. We just have to create a `Mechanism`, a timer (we will use the `AMHFixedPointTimer`), and make it run!
+#
+# We will run the control loop every 5 ms (i.e., at 200 Hz). If you want to know how well your hub keeps up with that,
+# give `run` a `duration_ms` and call `print_stats()` afterwards. If you see many overruns, increase `CONTROL_PERIOD_US`
+# (and maybe re-tune `Kp`).
+
+# %%
+CONTROL_PERIOD_US = 5000
+
+# %% [markdown]
+# By default, we use Anton's proportional controller. If you want to make the AT-AT MS5 walk faster (i.e., with a shorter `T`),
+# set `USE_PID` to `True` to use the `PIDMechanism` instead. You will probably need to tune its gains for your robot.
+
+# %%
+USE_PID = False
+
+# %% [markdown]
+# Printing things inside the control loop is a bad idea: it takes time and it can mess up the motor synchronization.
+# However, sometimes we do want to know what is going on. For that, the `Mechanism` can record its telemetry:
+# the ticks, and the target, position and pwm of every motor in each control cycle.
+# It is stored in a ring buffer (i.e., only the last `TELEMETRY_RECORDS` cycles are kept) that is created only once,
+# so recording takes only a few microseconds per cycle. Once the walk stops (e.g., when you stop the program),
+# everything is written to `TELEMETRY_FILE` in the hub in one go. You can then read it in your computer with
+# [`tools/telemetry_reader.py`](https://github.com/arturomoncadatorres/lego-mindstorms/blob/main/tools/telemetry_reader.py).
+# If you set `TELEMETRY_FILE` to `None`, it will be printed in the console instead.
+#
+# It is disabled by default (`TELEMETRY_RECORDS = 0`), since it writes a file to the hub every time the program runs.
+# To enable it, set `TELEMETRY_RECORDS` to the number of cycles you want to keep (e.g., `1000`, which are 5 s at 200 Hz).
+
+# %%
+TELEMETRY_RECORDS = 0
+TELEMETRY_FILE = "atat_telemetry.bin"
+
+# %% [markdown]
+# If the legs aren't at their starting position when the program starts (e.g., because you moved them by hand),
+# the first steps can be quite abrupt. Set `RESET_LEGS` to `True` to first bring them there smoothly
+# with `shortest_path_reset`.
+
+# %%
+RESET_LEGS = False
 
 # %%
 motors = [motor_a, motor_b, motor_e, motor_f]
 motor_functions = [motor_a_function, motor_b_function, motor_e_function, motor_f_function]
-atat_walk_mechanism = Mechanism(motors, motor_functions, ramp_pwm=50)
+if USE_PID:
+    atat_walk_mechanism = PIDMechanism(motors, motor_functions, ramp_pwm=50, Kp=1.2, Ki=0.5, Kd=0.01, Kff=0.1, deadband=1)
+else:
+    atat_walk_mechanism = Mechanism(motors, motor_functions, ramp_pwm=50)
+
+if TELEMETRY_RECORDS:
+    atat_walk_mechanism.enable_telemetry(TELEMETRY_RECORDS)
+
+# Get the legs smoothly to their starting position.
+# If a leg couldn't get there (e.g., because it is stuck), we let you know.
+if RESET_LEGS:
+    print("Moving legs to starting position...")
+    unsettled = atat_walk_mechanism.shortest_path_reset()
+    for motor_index, reason in unsettled:
+        log.warning("Leg %d didn't reach its starting position (%s)", motor_index, reason)
+    print("DONE!")
 
 # Define timer
-timer = AMHTimer()
+timer = AMHFixedPointTimer()
 timer.reset()
 
+# Define control loop
+control_loop = ControlLoop(atat_walk_mechanism, timer, period_us=CONTROL_PERIOD_US)
+
 # Make the AT-AT MS5 walk!
+# Do note that printing things inside the control loop (e.g., the value
+# of the timer) might mess up the motor synchronization, since the loop
+# is quite tight and printing things takes time, even if it is only a fraction.
+# Use the telemetry instead (or log.debug, which only prints with LOG_LEVEL = Logger.DEBUG).
 print("Starting walk...")
-while True:
-    # For debugging purposes, you can print the value of the timer by
-    # uncommenting the following line. Do note that this might
-    # mess up the motor synchronization, since the timer is quite tight
-    # and priting things takes time, even if it is only a fraction.
-    # print("timer = " + str(timer.time))
-    atat_walk_mechanism.update_motor_pwms(timer.time)
-
-# Actually, we will actually never reach this point.
-# However, I leave it here in case you decide to change
-# the stopping condition of your robot.
-atat_walk.stop()
-print("DONE!")
+try:
+    control_loop.run()
+
+# The walk goes on until you stop the program (unless you change
+# the stopping condition of your robot, e.g., control_loop.run(duration_ms=60000)).
+# Either way, we stop the motors and save what happened.
+finally:
+    atat_walk_mechanism.stop()
+    control_loop.print_stats()
+    atat_walk_mechanism.dump_telemetry(TELEMETRY_FILE)
+    print("DONE!")
 
 print("-"*15 + " Execution ended " + "-"*15 + "\n")
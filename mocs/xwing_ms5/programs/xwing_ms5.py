@@ -49,16 +49,101 @@ import math
 # Since we want to play sounds, we need to do everything through hub.
 import hub
 
+# %%
+# Required for doing things on time without blocking the program
+# (e.g., playing animations or controlling the base motors).
+from utime import ticks_add, ticks_diff, ticks_ms, ticks_us
+
+# Required for the moving average filter and the servo.
+from array import array
+
 # %%
 print("-"*15 + " Execution started " + "-"*15 + "\n")
 
 
+# %% [markdown]
+# ## Logging
+# Printing is slow on the hub, so `log` only prints the messages of the enabled levels.
+# Set `LOG_LEVEL = Logger.DEBUG` to see what happens inside the loops (take a look at Charlie's
+# [`drum_solo`](https://nbviewer.jupyter.org/github/arturomoncadatorres/lego-mindstorms/blob/main/base/charlie/programs/drum_solo.ipynb?flush_cache=True) for a more detailed explanation).
+
+# %%
+class Logger():
+    """
+    Prints the messages of the enabled levels (DEBUG, INFO, WARNING or ERROR), formatting
+    them only then (and at most once per every_ms milliseconds, if given).
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+    def __init__(self, level=20):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        level:
+            Messages below this level are ignored.
+            Default value is Logger.INFO.
+        """
+        self.last_ticks = {} # Template: ticks_ms() of the last time it was printed.
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = level
+        self.debug = self._debug if level <= self.DEBUG else self._off
+        self.info = self._info if level <= self.INFO else self._off
+        self.warning = self._warning if level <= self.WARNING else self._off
+        self.error = self._error if level <= self.ERROR else self._off
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are printed.
+        """
+        return level >= self.level
+
+    def _off(self, message, *args, every_ms=0):
+        pass
+
+    def _debug(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _info(self, message, *args, every_ms=0):
+        self.log(message, args, every_ms)
+
+    def _warning(self, message, *args, every_ms=0):
+        self.log("WARNING: " + message, args, every_ms, message)
+
+    def _error(self, message, *args, every_ms=0):
+        self.log("ERROR: " + message, args, every_ms, message)
+
+    def log(self, message, args, every_ms=0, key=None):
+        if every_ms:
+            if key is None:
+                key = message
+            now = ticks_ms()
+            last = self.last_ticks.get(key)
+            if last is not None and ticks_diff(now, last) < every_ms:
+                return
+            self.last_ticks[key] = now
+        if args:
+            message = message % args
+        print(message)
+
+
+# %%
+LOG_LEVEL = Logger.INFO
+log = Logger(LOG_LEVEL)
+
 # %% [markdown]
 # ## Initialize motors
 
 # %%
 # Motor for opening/closing the S-foils (i.e., wings).
 motor_wings = Motor('A') 
+raw_wings = hub.port.A.motor
 
 # Motors for tilting the ship
 # Due to the weight of the ship, we need two motors.
@@ -76,16 +161,216 @@ motors_base = motor_b.pair(motor_d)
 print("Initializing motors to position 0...")
 motor_wings.run_to_position(350, direction='shortest path', speed=100)
 motors_base.preset(0, 0)
+
+# The relative position of the wings motor starts where the absolute one is
+# (between -180 and 180), so 350 becomes -10.
+wings_position = raw_wings.get()[2]
+if wings_position > 180:
+    wings_position -= 360
+raw_wings.preset(wings_position)
 print("DONE!")
 
 
+# %% [markdown]
+# The base motors need to follow the hub all the time. If we gave them a new
+# `run_to_position` every time the angle changes (even if it is just a fraction
+# of a degree), the ship would lag a lot behind the hub (and the loop would slow down).
+# Instead, a `PositionServo` controls their power directly at a fixed rate,
+# towards a setpoint that we can change as often as we want.
+
+# %%
+class PositionServo():
+    """
+    Keeps a group of "raw" motors (e.g., hub.port.B.motor) at a setpoint that
+    can change all the time, without issuing a new (blocking) move for every change.
+    update() runs a proportional controller on the pwm of each motor at a fixed rate
+    (call it as often as possible).
+    """
+
+    def __init__(self, motors, period_ms=10, Kp=3, deadband=1, max_pwm=100):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        motors:
+            List of "raw" motors.
+        period_ms:
+            Period of the controller (in ms).
+            Default value is 10.
+        Kp:
+            Proportional gain (pwm per degree of error).
+            Default value is 3.
+        deadband:
+            Changes of the setpoint and errors smaller than this (in degrees)
+            are ignored, so that the motors don't twitch around their target.
+            Default value is 1.
+        max_pwm:
+            Maximum pwm (in %).
+            Default value is 100.
+        """
+        self.motors = motors
+        self.period_us = period_ms * 1000
+        self.Kp = Kp
+        self.deadband = deadband
+        self.max_pwm = max_pwm
+
+        n_motors = len(motors)
+        self.setpoints = array('f', [0] * n_motors)
+        self.powers = array('i', [0] * n_motors)
+        self.next_ticks = ticks_us()
+
+    def set_setpoint(self, index, setpoint):
+        """
+        Sets the setpoint (in degrees) of the motor with the given index.
+        Changes within the deadband are ignored.
+        """
+        if abs(setpoint - self.setpoints[index]) > self.deadband:
+            self.setpoints[index] = setpoint
+
+    def update(self):
+        """
+        Updates the pwm of the motors if it is time to. Returns True if it did.
+        """
+        now = ticks_us()
+        if ticks_diff(now, self.next_ticks) < 0:
+            return False
+        self.next_ticks = ticks_add(self.next_ticks, self.period_us)
+        if ticks_diff(now, self.next_ticks) >= 0:
+            # We are more than a period late. Don't try to catch up.
+            self.next_ticks = ticks_add(now, self.period_us)
+
+        max_pwm = self.max_pwm
+        for ii in range(len(self.motors)):
+            motor = self.motors[ii]
+            error = self.setpoints[ii] - motor.get()[1]
+            if -self.deadband <= error <= self.deadband:
+                # Hold the motor where it is (braking resists the weight of
+                # the ship better than letting it float).
+                if self.powers[ii] != 0:
+                    motor.brake()
+                    self.powers[ii] = 0
+                continue
+
+            power = min(max(int(self.Kp * error), -max_pwm), max_pwm)
+            if power != self.powers[ii]:
+                motor.pwm(power)
+                self.powers[ii] = power
+        return True
+
+    def stop(self):
+        for motor in self.motors:
+            motor.pwm(0)
+        for ii in range(len(self.powers)):
+            self.powers[ii] = 0
+
+
+# %%
+base_servo = PositionServo([motor_b, motor_d])
+
+
 # %% [markdown]
 # ## Initialize conditions
-# `WINGS_CLOSED` will keep track of the state of the wings.
+# The wings move very slowly (it looks much cooler). If we waited for them,
+# the ship would stop following the hub (and we couldn't fire) for several seconds.
+# Instead, `SFoils` starts the motion and lets the motor do its thing, while
+# it keeps track of the state of the wings.
+
+# %%
+class SFoils():
+    """
+    Opens and closes the S-foils (i.e., the wings) in the background.
+    The motor moves on its own, and update() (call it as often as possible)
+    keeps track of the state: 'closed', 'opening', 'open' or 'closing'.
+    """
+
+    def __init__(self, motor, open_position=20, closed_position=-10, speed=2, tolerance=3):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        motor:
+            "Raw" motor of the wings (e.g., hub.port.A.motor).
+            Its (relative) position must be 0 at the absolute position 0.
+        open_position:
+            Position of the open wings (in degrees).
+            Default value is 20.
+        closed_position:
+            Position of the closed wings (in degrees).
+            Default value is -10 (i.e., 350, with a little bit of tension).
+        speed:
+            Speed of the wings (in %).
+            Default value is 2.
+        tolerance:
+            The wings are considered to be in position when they stopped
+            within this many degrees of it.
+            Default value is 3.
+        """
+        self.motor = motor
+        self.open_position = open_position
+        self.closed_position = closed_position
+        self.speed = speed
+        self.tolerance = tolerance
+        self.state = 'closed'
+
+    def open(self):
+        """
+        Starts opening the wings (also if they are closing).
+        """
+        if self.state in ('closed', 'closing'):
+            self.motor.run_to_position(self.open_position, self.speed)
+            self.state = 'opening'
+
+    def close(self):
+        """
+        Starts closing the wings (also if they are opening).
+        """
+        if self.state in ('open', 'opening'):
+            self.motor.run_to_position(self.closed_position, self.speed)
+            self.state = 'closing'
+
+    def toggle(self):
+        """
+        Opens the wings if they are (or are getting) closed, and vice versa.
+        """
+        if self.state in ('closed', 'closing'):
+            self.open()
+        else:
+            self.close()
+
+    def update(self):
+        """
+        Checks whether the wings got to their position. Returns the state.
+        """
+        if self.state == 'opening':
+            target = self.open_position
+        elif self.state == 'closing':
+            target = self.closed_position
+        else:
+            return self.state
+
+        speed, position = self.motor.get()[0:2]
+        if speed == 0 and abs(position - target) <= self.tolerance:
+            if self.state == 'opening':
+                self.state = 'open'
+            else:
+                self.state = 'closed'
+        return self.state
+
+    def is_open(self):
+        return self.state == 'open'
+
+    def is_closed(self):
+        return self.state == 'closed'
+
+    def is_moving(self):
+        return self.state in ('opening', 'closing')
+
 
 # %%
 print("Initializing conditions...")
-WINGS_CLOSED = True
+sfoils = SFoils(raw_wings)
 
 # %% [markdown]
 # In order to avoid sudden changes in the angle, we will use a simple
@@ -95,12 +380,175 @@ WINGS_CLOSED = True
 # I experimented with different sizes and this one was acceptable in making 
 # the movement smoother without making the response sluggish. 
 # I think up to 7 or 8 is ok, a window size of more than 10 makes it very slow.
+#
+# The filter keeps the samples in a ring buffer together with their sum, so
+# updating it takes the same time for any window size. If you want to try larger
+# windows, you can also use `WINDOW_MODE = 'weighted'` (the newest samples weigh more)
+# or `'ema'` (an exponential moving average), which react faster for the same smoothing.
+
+# %%
+class MovingAverage():
+    """
+    Moving average filter with a constant cost per sample (no matter the window size).
+    The samples are kept in a ring buffer, together with their (running) sum.
+    """
+
+    def __init__(self, window_size, mode='mean', alpha=None, initial=0):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        window_size:
+            Number of samples of the window.
+        mode:
+            'mean' (all samples weigh the same), 'weighted' (linearly
+            decreasing weights, from window_size for the newest sample to 1
+            for the oldest one) or 'ema' (exponential moving average).
+            Default value is 'mean'.
+        alpha:
+            Weight of the newest sample in the EMA (between 0 and 1).
+            If None, 2 / (window_size + 1), which has the same center of mass as the mean.
+            Default value is None.
+        initial:
+            Initial value of the samples.
+            Default value is 0.
+        """
+        self.samples = array('f', [initial] * window_size)
+        self.index = 0 # Oldest sample (i.e., the next one to be replaced).
+        self.mode = mode
+        if alpha is None:
+            alpha = 2 / (window_size + 1)
+        self.alpha = alpha
+
+        self.sum = initial * window_size
+        self.weighted_sum = initial * window_size * (window_size + 1) / 2
+        self.ema = initial
+
+    def update(self, sample):
+        """
+        Adds a new sample. Returns the filtered value.
+        """
+        n = len(self.samples)
+        if self.mode == 'ema':
+            self.ema += self.alpha * (sample - self.ema)
+            return self.ema
+
+        # Every sample loses one unit of weight (i.e., the sum) and the new one gets n.
+        self.weighted_sum += n * sample - self.sum
+        self.sum += sample - self.samples[self.index]
+        self.samples[self.index] = sample
+        self.index = (self.index + 1) % n
+
+        # Every window, we calculate the sums from scratch,
+        # so that rounding errors don't accumulate.
+        if self.index == 0:
+            self.sum = 0
+            self.weighted_sum = 0
+            for ii in range(n):
+                self.sum += self.samples[ii]
+                self.weighted_sum += (ii + 1) * self.samples[ii]
+
+        if self.mode == 'weighted':
+            return self.weighted_sum / (n * (n + 1) / 2)
+        return self.sum / n
+
 
 # %%
 WINDOW_SIZE = 3
+WINDOW_MODE = 'mean'
+
+angleB_filter = MovingAverage(WINDOW_SIZE, mode=WINDOW_MODE)
+angleD_filter = MovingAverage(WINDOW_SIZE, mode=WINDOW_MODE)
+
+
+# %% [markdown]
+# However, any moving average makes the ship lag behind the hub: the mean of the
+# last few samples is where the hub *was* a little while ago. Besides, the loop
+# reads the hub orientation whenever it gets to it (which isn't at a regular rate).
+#
+# Instead, a `RollSampler` reads the roll at a fixed rate and feeds an
+# [alpha-beta filter](https://en.wikipedia.org/wiki/Alpha_beta_filter), which estimates
+# both the roll and how fast it changes. With that, we can estimate the roll at the
+# moment we give the command to the motors. This is what we use by default
+# (`TILT_FILTER = 'alpha-beta'`). To go back to the moving average, use
+# `TILT_FILTER = 'moving average'`.
 
-angleB_array = [0.001] * WINDOW_SIZE
-angleD_array = [0.001] * WINDOW_SIZE
+# %%
+class RollSampler():
+    """
+    Reads the roll of the hub at a fixed rate (call update() as often as possible)
+    and estimates the roll and its rate of change with an alpha-beta filter.
+    With the rate, we can estimate the roll at any moment after the last sample.
+    """
+
+    def __init__(self, period_ms=10, alpha=0.5, beta=0.15):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        period_ms:
+            Sampling period (in ms).
+            Default value is 10.
+        alpha:
+            How much the roll estimate follows each new sample (between 0 and 1).
+            Default value is 0.5.
+        beta:
+            How much the rate estimate follows each new sample (between 0 and 1).
+            Default value is 0.15.
+        """
+        self.period_us = period_ms * 1000
+        self.alpha = alpha
+        self.beta = beta
+
+        self.sample = 0 # Last measured roll (in degrees).
+        self.sample_ticks = None
+        self.next_ticks = 0
+        self.roll = 0 # Estimated roll at sample_ticks (in degrees).
+        self.rate = 0 # Estimated rate (in degrees/s).
+
+    def update(self):
+        """
+        Takes a new sample if it is time to. Returns True if it did.
+        """
+        now = ticks_us()
+        if self.sample_ticks is not None and ticks_diff(now, self.next_ticks) < 0:
+            return False
+        yaw, pitch, roll = hub.motion.yaw_pitch_roll()
+
+        if self.sample_ticks is None:
+            self.roll = roll
+            self.rate = 0
+            self.next_ticks = now
+        else:
+            dt = ticks_diff(now, self.sample_ticks) / 1000000
+            # Predict where the roll should be by now, and correct the
+            # prediction (and the rate) with the difference to the sample.
+            predicted = self.roll + self.rate * dt
+            residual = roll - predicted
+            self.roll = predicted + self.alpha * residual
+            self.rate += self.beta * residual / dt
+        self.sample = roll
+        self.sample_ticks = now
+
+        self.next_ticks = ticks_add(self.next_ticks, self.period_us)
+        if ticks_diff(now, self.next_ticks) >= 0:
+            # We are more than a period late. Don't try to catch up.
+            self.next_ticks = ticks_add(now, self.period_us)
+        return True
+
+    def roll_at(self, ticks):
+        """
+        Returns the estimated roll (in degrees) at the given time (from ticks_us()).
+        """
+        return self.roll + self.rate * ticks_diff(ticks, self.sample_ticks) / 1000000
+
+
+# %%
+TILT_FILTER = 'alpha-beta'
+
+imu = RollSampler()
 
 
 # %% [markdown]
@@ -108,6 +556,72 @@ angleD_array = [0.001] * WINDOW_SIZE
 # This is pretty much identical to what I used for the
 # [AAT MS5](https://github.com/arturomoncadatorres/lego-mindstorms/tree/main/mocs/aat_ms5) robot
 # (except it is flipped from top to bottom due to the orientation of the hub).
+#
+# However, we can't afford to block the program while the animation plays
+# (the ship would stop following the hub). Thus, we will use an `AnimationPlayer`.
+# It builds the images only once and shows each frame when it is due. We just
+# need to call its `update()` in every iteration of the main loop.
+
+# %%
+class AnimationPlayer():
+    """
+    Plays an animation on the hub display without blocking the program.
+    The images of the frames are built only once, and update() shows
+    the next frame when it is due (call it as often as possible).
+    """
+
+    def __init__(self, frames, frame_ms=50):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        frames:
+            List of frames (as strings for hub.Image, e.g., '00000:00500:...').
+        frame_ms:
+            Duration of each frame (in ms).
+            Default value is 50.
+        """
+        self.images = [hub.Image(frame) for frame in frames]
+        self.frame_us = frame_ms * 1000
+        self.frame = None # Index of the current frame (None if not playing).
+        self.next_ticks = 0
+
+    def play(self):
+        """
+        Starts (or restarts) the animation.
+        """
+        self.frame = 0
+        self.next_ticks = ticks_add(ticks_us(), self.frame_us)
+        hub.display.show(self.images[0])
+
+    def is_playing(self):
+        return self.frame is not None
+
+    def update(self):
+        """
+        Shows the next frame if it is due. Returns True while the animation is playing.
+        """
+        if self.frame is None:
+            return False
+        now = ticks_us()
+        if ticks_diff(now, self.next_ticks) < 0:
+            return True
+
+        # If we are late, skip frames (so that the animation keeps its duration),
+        # but always show the last one.
+        shown = self.frame
+        while ticks_diff(now, self.next_ticks) >= 0:
+            self.frame += 1
+            self.next_ticks = ticks_add(self.next_ticks, self.frame_us)
+        if self.frame >= len(self.images):
+            if shown < len(self.images) - 1:
+                hub.display.show(self.images[-1])
+            self.frame = None
+            return False
+        hub.display.show(self.images[self.frame])
+        return True
+
 
 # %%
 # Define animation frames for the laser cannon.
@@ -121,12 +635,169 @@ frames = ['00000:00000:00000:00000:00000',
 '00900:00000:00000:00000:00000',
 '00000:00000:00000:00000:00000']
 
-n_frames = len(frames)
 t_pause = 0.05 # Pause between frames (in seconds)
 
+laser = AnimationPlayer(frames, frame_ms=int(t_pause * 1000))
+
 print("DONE!")
 
 
+# %% [markdown]
+# ## Handle the buttons
+# Instead of checking in every iteration of the loop whether a button was pressed,
+# we tell `ButtonEvents` what to do when each button is pressed. The firmware
+# lets it know as soon as that happens, and it calls our functions at the beginning
+# of the next iteration (so they never change the wings in the middle of an update).
+
+# %%
+class ButtonEvents():
+    """
+    Calls a handler when a button of the hub is pressed, held down or released.
+
+    When the firmware can call us back when a button changes (button.callback),
+    the callback only records when it happened. The handlers are always called
+    from poll() (call it as often as possible, e.g., once per iteration of the
+    main loop), so they never run while the program is in the middle of
+    something else. poll() also checks the buttons without callback, gives the
+    'long_press' events and catches the changes that were ignored as bounces.
+    """
+
+    def __init__(self, debounce_ms=20, long_press_ms=800):
+        """
+        Initialization
+
+        Parameters
+        ----------
+        debounce_ms:
+            Changes of a button within this time after the previous one are ignored.
+            Default value is 20.
+        long_press_ms:
+            A button that is held down this long gives a 'long_press' event
+            (right when it reaches this time, before it is released).
+            Default value is 800.
+        """
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        # name: [button, pressed, press_ticks, change_ticks, long_pressed, press_edge, release_edge]
+        # The edges are the ticks_ms() of the last press and release recorded
+        # by the callback since the last poll() (or -1).
+        self.buttons = {}
+        self.handlers = {} # (name, event): handler
+
+    def add_button(self, name, button):
+        """
+        Starts listening to a button (e.g., hub.button.left).
+        """
+        state = [button, False, 0, ticks_ms(), False, -1, -1]
+        self.buttons[name] = state
+        try:
+            # The firmware calls back with 0 when the button is pressed and with
+            # the time (in ms) that it was pressed when it is released.
+            button.callback(lambda time_ms: self.record(state, time_ms == 0))
+        except AttributeError:
+            pass
+
+    def record(self, state, pressed):
+        """
+        Records an edge of a button (called by the firmware).
+        """
+        state[5 if pressed else 6] = ticks_ms()
+
+    def on(self, name, event, handler):
+        """
+        Calls handler() on event ('press', 'long_press' or 'release') of the button name.
+        """
+        self.handlers[(name, event)] = handler
+
+    def emit(self, name, event):
+        """
+        Calls the handler of event of the button name (if any).
+        """
+        handler = self.handlers.get((name, event))
+        if handler is not None:
+            handler()
+
+    def change(self, name, pressed, ticks):
+        """
+        Handles a change of a button at ticks (ignoring it if it is a bounce).
+        """
+        state = self.buttons[name]
+        if pressed == state[1]:
+            return
+        if ticks_diff(ticks, state[3]) < self.debounce_ms:
+            return
+        state[1] = pressed
+        state[3] = ticks
+        if pressed:
+            state[2] = ticks
+            state[4] = False
+            self.emit(name, 'press')
+        else:
+            self.emit(name, 'release')
+
+    def poll(self):
+        """
+        Calls the handlers of the changes of the buttons since the last poll().
+        """
+        for name in self.buttons:
+            state = self.buttons[name]
+
+            # Edges recorded by the callback (in the order in which they happened).
+            press = state[5]
+            state[5] = -1
+            release = state[6]
+            state[6] = -1
+            if press >= 0 and release >= 0 and ticks_diff(release, press) < 0:
+                self.change(name, False, release)
+                release = -1
+            if press >= 0:
+                self.change(name, True, press)
+            if release >= 0:
+                self.change(name, False, release)
+
+            now = ticks_ms()
+            if ticks_diff(now, state[3]) >= self.debounce_ms:
+                self.change(name, state[0].is_pressed(), now)
+            if state[1] and not state[4] and ticks_diff(now, state[2]) >= self.long_press_ms:
+                state[4] = True
+                self.emit(name, 'long_press')
+
+
+# %%
+def toggle_wings():
+    log.info("Right button was pressed")
+
+    # If the wings were (or were getting) closed, open them.
+    # Otherwise, close them.
+    sfoils.toggle()
+    log.info("Wings are %s...", sfoils.state)
+
+
+def fire():
+    log.info("Left button was pressed")
+
+    # If the wings were closed (or moving)...
+    if not sfoils.is_open():
+        log.info("Can't shoot with S-foils %s!", sfoils.state)
+
+    # If the wings were opened...
+    else:
+        log.info("Laser cannons fired!")
+
+        # ...play sound...
+        hub.sound.play("/extra_files/Laser")
+
+        # ...and start the laser cannon animation.
+        laser.play()
+
+
+buttons = ButtonEvents()
+buttons.add_button('left', hub.button.left)
+buttons.add_button('right', hub.button.right)
+buttons.on('right', 'press', toggle_wings)
+buttons.on('left', 'press', fire)
+
+
 # %% [markdown]
 # ## Putting the X-Wing MS5 in action!
 #
@@ -153,78 +824,63 @@ print("DONE!")
 # %%
 while True:
 
-    if hub.button.right.was_pressed():
-        print("Right button was pressed")
-
-        # If the wings were closed...
-        if WINGS_CLOSED == True:
-            # ...open them.
-            motor_wings.run_to_position(20, direction='shortest path', speed=2)
-            WINGS_CLOSED = False
-            print("Wings are open!")
+    # Handle what happened with the buttons since the last iteration.
+    buttons.poll()
 
-        # If the wings were opened...
-        elif WINGS_CLOSED == False:
-            # ...close them.
-            motor_wings.run_to_position(350, direction='shortest path', speed=2)
-            WINGS_CLOSED = True
-            print("Wings are closed!")
+    # Check whether the wings got where they were going.
+    if sfoils.is_moving():
+        sfoils.update()
+        if not sfoils.is_moving():
+            log.info("Wings are %s!", sfoils.state)
 
 
-    if hub.button.left.was_pressed():
-        print("Left button was pressed")
+    # Show the next frame of the animation (if it is playing and it is time to).
+    laser.update()
 
-        # If the wings were closed...
-        if WINGS_CLOSED == True:
-            print("Can't shoot with S-foils closed!")
+    # Read the roll of the hub (only if it is time to).
+    new_sample = imu.update()
 
-        # If the wings were opened...
-        elif WINGS_CLOSED == False:
-            print("Laser cannons fired!")
-
-            # ...play sound...
-            hub.sound.play("/extra_files/Laser")
-
-            # ...and display laser cannon animation.
-            for ii in range(0, n_frames):
-                img = hub.Image(frames[ii])
-                hub.display.show(img)
-                wait_for_seconds(t_pause)
-            
-    
-    yaw, pitch, roll = hub.motion.yaw_pitch_roll()
+    if TILT_FILTER == 'alpha-beta' or new_sample:
+        if TILT_FILTER == 'alpha-beta':
+            # Estimate the roll right now (i.e., when we give the command
+            # to the motors), instead of using the last (older) sample.
+            roll = imu.roll_at(ticks_us())
+        else:
+            roll = imu.sample
 
-    # We will map the roll from -90 to 90 to a defined range
-    # by dividing it by a factor.
-    max_angle = 30
-    angle_factor = 90/max_angle
-    angle = roll/angle_factor
+        # We will map the roll from -90 to 90 to a defined range
+        # by dividing it by a factor.
+        max_angle = 30
+        angle_factor = 90/max_angle
+        angle = roll/angle_factor
     
-    # Notice how we limit the range of the motors movement
-    # between -max_angle and max_angle (otherwise the X-Wing tilts too much)
-    if angle >= 0:
-        angleB = max([-angle, -max_angle])
-        angleD = min([angle, max_angle])
-    if angle < 0:
-        angleB = min([-angle, max_angle])
-        angleD = max([angle, -max_angle])
-    print("Roll = " + str(roll) + "; max angle = " + str(max_angle) + "; angle = " + str(angle) + "; angleB = " + str(angleB) + "; angleD = " + str(angleD))
-
-    # Update the angle arrays by appending the new sample at the end of
-    # the array while popping the first sample.
-    angleB_array.append(angleB)
-    angleB_array.pop(0)
-
-    angleD_array.append(angleD)
-    angleD_array.pop(0)
-
-    # Get the mean of the current window and use it for setting the
-    # motor positions.
-    angleB_mean = sum(angleB_array)/WINDOW_SIZE
-    angleD_mean = sum(angleD_array)/WINDOW_SIZE
-
-    print("Mean of angleB = " + str(angleB_mean) + "; mean of angleD = " + str(angleD_mean))
-    motors_base.run_to_position(angleB_mean, angleD_mean, speed=10, max_power=100, stop=2)
+        # Notice how we limit the range of the motors movement
+        # between -max_angle and max_angle (otherwise the X-Wing tilts too much)
+        if angle >= 0:
+            angleB = max([-angle, -max_angle])
+            angleD = min([angle, max_angle])
+        if angle < 0:
+            angleB = min([-angle, max_angle])
+            angleD = max([angle, -max_angle])
+        if log.enabled(Logger.DEBUG):
+            log.debug("Roll = %s; max angle = %s; angle = %s; angleB = %s; angleD = %s",
+                      roll, max_angle, angle, angleB, angleD, every_ms=200)
+
+        if TILT_FILTER == 'moving average':
+            # Add the new samples to the filters and use the mean of the current
+            # window for setting the motor positions.
+            angleB_mean = angleB_filter.update(angleB)
+            angleD_mean = angleD_filter.update(angleD)
+        else:
+            angleB_mean = angleB
+            angleD_mean = angleD
+
+        if log.enabled(Logger.DEBUG):
+            log.debug("Mean of angleB = %s; mean of angleD = %s", angleB_mean, angleD_mean, every_ms=200)
+        base_servo.set_setpoint(0, angleB_mean)
+        base_servo.set_setpoint(1, angleD_mean)
+
+    base_servo.update()
     
     
 # We will never get here.
@@ -0,0 +1,225 @@
+"""
+Offline simulation of the AT-AT MS5 walking.
+
+It runs the (unmodified) control code of mocs/atat_ms5/programs/atat_ms5.py
+(Mechanism or PIDMechanism, ControlLoop and the timers) against four simulated
+motors on a virtual clock. It reports the tracking error of each leg and how
+many commands were sent to each motor, so you can compare controllers and
+parameters without the robot (and without waiting in real time).
+
+Usage:
+    python tools/atat_simulator.py --duration 20000 --kp 1.2 --ramp-pwm 50
+    python tools/atat_simulator.py --period 2000 --controller pid --json
+"""
+
+import argparse
+import json
+import math
+import os
+
+import hub_mock
+
+ATAT_PROGRAM = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'mocs', 'atat_ms5', 'programs', 'atat_ms5.py')
+
+# Port, factor and shift (as a fraction of the period) of each leg,
+# in the same order as in the AT-AT MS5 program.
+LEGS = [('A', 1, 1/4), ('B', -1, 3/4), ('E', 1, 1/2), ('F', -1, 0)]
+
+
+def simulate_atat(period=4000, Kp=1.2, ramp_pwm=50, t_shifts=None, controller='p', pid_gains=None,
+                  timer='fixed', table=True, duration_ms=20000, warmup_ms=2000, control_period_us=5000,
+                  motor_params=None, initial_positions=None, program=ATAT_PROGRAM):
+    """
+    Simulates the AT-AT MS5 walking.
+
+    Parameters
+    ----------
+    period: integer
+        Period T of the walking cycle (in ms).
+        Default value is 4000.
+
+    Kp, ramp_pwm:
+        Parameters of the Mechanism.
+        Default values are 1.2 and 50.
+
+    t_shifts: list
+        Shift of each leg (A, B, E, F) in ms. If None, the shifts of the program are used.
+        Default value is None.
+
+    controller: string
+        'p' for Mechanism or 'pid' for PIDMechanism.
+        Default value is 'p'.
+
+    pid_gains: dict
+        Extra keyword arguments for PIDMechanism (e.g., {'Ki': 0.5, 'Kff': 0.1}).
+        Default value is None.
+
+    timer: string
+        'fixed' for AMHFixedPointTimer or 'float' for AMHTimer.
+        Default value is 'fixed'.
+
+    table: boolean
+        If True, the legs use a GaitTable. Otherwise, they use atat_walk directly.
+        Default value is True.
+
+    duration_ms: integer
+        Duration of the (virtual) walk (in ms).
+        Default value is 20000.
+
+    warmup_ms: integer
+        The tracking error during the first warmup_ms is ignored.
+        Default value is 2000.
+
+    control_period_us: integer
+        Period of the ControlLoop (in us).
+        Default value is 5000.
+
+    motor_params: dict or list
+        Keyword arguments for SimulatedMotor (a dict for all legs or a list with one dict per leg).
+        Default value is None.
+
+    initial_positions: list
+        Initial absolute position of each leg (in degrees).
+        Default value is None (all legs at 0).
+
+    program: string
+        Path to the AT-AT MS5 program.
+
+    Returns
+    -------
+    results: dict
+        Tracking error per leg, command counts and control loop statistics.
+    """
+    clock = hub_mock.VirtualClock()
+    utime = hub_mock.make_utime(clock)
+
+    if motor_params is None:
+        motor_params = {}
+    if isinstance(motor_params, dict):
+        motor_params = [motor_params] * len(LEGS)
+    if initial_positions is None:
+        initial_positions = [0] * len(LEGS)
+
+    motors = [hub_mock.SimulatedMotor(clock, position=position, **params)
+              for params, position in zip(motor_params, initial_positions)]
+    hub = hub_mock.make_hub({port: motor for (port, _, _), motor in zip(LEGS, motors)})
+    atat = hub_mock.load_program(program, {'utime': utime, 'hub': hub}, {'log': hub_mock.FakeLogger()})
+
+    if t_shifts is None:
+        t_shifts = [int(shift * period) for _, _, shift in LEGS]
+    if table:
+        gait = atat['GaitTable'](atat['atat_walk'](1, period=period), period=period)
+        motor_functions = [gait.function(factor, t_shift=t_shift)
+                           for (_, factor, _), t_shift in zip(LEGS, t_shifts)]
+    else:
+        motor_functions = [atat['atat_walk'](factor, period=period, t_shift=t_shift)
+                           for (_, factor, _), t_shift in zip(LEGS, t_shifts)]
+
+    if controller == 'pid':
+        mechanism = atat['PIDMechanism'](motors, motor_functions, ramp_pwm=ramp_pwm, Kp=Kp, **(pid_gains or {}))
+    else:
+        mechanism = atat['Mechanism'](motors, motor_functions, ramp_pwm=ramp_pwm, Kp=Kp)
+
+    if timer == 'float':
+        walk_timer = atat['AMHTimer']()
+    else:
+        walk_timer = atat['AMHFixedPointTimer']()
+    walk_timer.reset()
+
+    # Record the tracking error every ms (of the virtual clock).
+    n_legs = len(LEGS)
+    sum_squares = [0.0] * n_legs
+    max_error = [0.0] * n_legs
+    sum_output_squares = [0.0] * n_legs
+    n_samples = [0]
+    start_us = clock.now_us
+
+    def record(now_us):
+        if now_us % 1000 or now_us - start_us < warmup_ms * 1000:
+            return
+        ticks = walk_timer.time
+        for ii, (motor, motor_function) in enumerate(zip(motors, motor_functions)):
+            target = motor_function(ticks)
+            error = target - (motor.position + motor.offset)
+            output_error = target - (motor.output_position + motor.offset)
+            sum_squares[ii] += error * error
+            sum_output_squares[ii] += output_error * output_error
+            max_error[ii] = max(max_error[ii], abs(error))
+        n_samples[0] += 1
+
+    clock.add_listener(record)
+    control_loop = atat['ControlLoop'](mechanism, walk_timer, period_us=control_period_us)
+    control_loop.run(duration_ms=duration_ms)
+    mechanism.stop()
+
+    n = max(n_samples[0], 1)
+    legs = {}
+    for ii, (port, _, _) in enumerate(LEGS):
+        legs[port] = {
+            'rms_error': math.sqrt(sum_squares[ii] / n),
+            'max_error': max_error[ii],
+            'rms_output_error': math.sqrt(sum_output_squares[ii] / n),
+            'commands': dict(motors[ii].counts),
+        }
+
+    return {
+        'period': period,
+        'legs': legs,
+        'rms_error': math.sqrt(sum(sum_squares) / (n * n_legs)),
+        'max_error': max(max_error),
+        'cycles': control_loop.cycles,
+        'overruns': control_loop.overruns,
+        'mean_period_us': control_loop.mean_period_us,
+        'max_jitter_us': control_loop.max_jitter_us,
+        'distance_cycles': walk_timer.time / period,
+    }
+
+
+def print_results(results):
+    print("Period = " + str(results['period']) + " ms; walking cycles = " + "%.2f" % results['distance_cycles'])
+    print("Control loop: " + str(results['cycles']) + " cycles; " + str(results['overruns']) + " overruns; "
+          + "mean period = " + str(results['mean_period_us']) + " us; max jitter = " + str(results['max_jitter_us']) + " us")
+    print("Leg  RMS error  Max error  RMS output error  get   pwm   preset  run_to_position")
+    for port, leg in results['legs'].items():
+        counts = leg['commands']
+        print("%-4s %9.2f  %9.2f  %16.2f  %-5d %-5d %-7d %d" % (
+            port, leg['rms_error'], leg['max_error'], leg['rms_output_error'],
+            counts['get'], counts['pwm'], counts['preset'], counts['run_to_position']))
+    print("All  %9.2f  %9.2f" % (results['rms_error'], results['max_error']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the AT-AT MS5 walking on a virtual clock.")
+    parser.add_argument('--period', type=int, default=4000, help="walking period T (in ms)")
+    parser.add_argument('--kp', type=float, default=1.2, help="proportional gain")
+    parser.add_argument('--ramp-pwm', type=float, default=50, help="ramp_pwm of the Mechanism")
+    parser.add_argument('--controller', choices=['p', 'pid'], default='p', help="controller to use")
+    parser.add_argument('--ki', type=float, default=0.5, help="integral gain (pid only)")
+    parser.add_argument('--kd', type=float, default=0.01, help="derivative gain (pid only)")
+    parser.add_argument('--kff', type=float, default=0.1, help="feed-forward gain (pid only)")
+    parser.add_argument('--timer', choices=['fixed', 'float'], default='fixed', help="timer to use")
+    parser.add_argument('--no-table', action='store_true', help="use atat_walk instead of a GaitTable")
+    parser.add_argument('--duration', type=int, default=20000, help="duration of the walk (in ms)")
+    parser.add_argument('--control-period', type=int, default=5000, help="control loop period (in us)")
+    parser.add_argument('--max-speed', type=float, default=1000, help="motor speed at full pwm (in degrees/s)")
+    parser.add_argument('--tau', type=float, default=0.05, help="motor time constant (in s)")
+    parser.add_argument('--load', type=float, default=10, help="load friction (in pwm)")
+    parser.add_argument('--backlash', type=float, default=0, help="backlash (in degrees)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = simulate_atat(
+        period=args.period, Kp=args.kp, ramp_pwm=args.ramp_pwm, controller=args.controller,
+        pid_gains={'Ki': args.ki, 'Kd': args.kd, 'Kff': args.kff}, timer=args.timer,
+        table=not args.no_table, duration_ms=args.duration, control_period_us=args.control_period,
+        motor_params={'max_speed': args.max_speed, 'tau': args.tau, 'load': args.load, 'backlash': args.backlash})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Offline feasibility check of walking patterns (metafunctions).
+
+It loads a metafunction (e.g., atat_walk) from a hub program and evaluates
+it for every leg on a dense time grid, all at once with NumPy. Since the hub
+version of atat_walk has branches (which don't work with arrays), it is
+replaced by a NumPy port of the same formula, which is checked against it.
+From that, it calculates the peak velocity and acceleration of each leg,
+looks for discontinuities (jumps in position and sudden changes of
+velocity), and counts how many legs are in the air at the same time. Everything that exceeds the given motor limits is
+flagged. Sweeping the period shows the shortest (i.e., fastest) period that
+the motors can still follow, without having to try it on the robot.
+
+It requires NumPy.
+
+Usage:
+    python tools/gait_analyzer.py --period 4000
+    python tools/gait_analyzer.py --sweep 800:4000:100 --max-velocity 600
+"""
+
+import argparse
+
+import numpy as np
+
+import hub_mock
+from atat_simulator import ATAT_PROGRAM, LEGS
+
+DEFAULT_LIMITS = {
+    'max_velocity': 600, # degrees/s
+    'max_acceleration': None, # degrees/s^2 (None: not checked)
+    'max_velocity_step': 300, # degrees/s in a single sample
+    'max_jump': 5, # degrees in a single sample
+    'max_airborne': 1, # legs in the air at the same time
+}
+
+# Changes of velocity (in degrees/s) smaller than this are rounding errors.
+VELOCITY_TOLERANCE = 1e-6
+
+
+def atat_walk_vectorized(factor=1, period=4000, t_shift=0):
+    """
+    NumPy port of atat_walk (same parameters and formula), whose motor
+    function evaluates a whole array of ticks at once.
+    """
+    def function(ticks):
+        ticks = ticks + t_shift
+        phase = ticks % period
+        turns = (ticks // period) * 360
+        air = factor * ((720 / period) * phase + turns)
+        ground = factor * (((240 / period) * phase + 120) + turns)
+        return np.where(phase <= period // 4, air, ground)
+
+    return function
+
+
+# NumPy ports of the metafunctions of the hub programs, by name.
+VECTORIZED = {
+    'atat_walk': atat_walk_vectorized,
+}
+
+
+def check_vectorized(metafunction, vectorized, periods=(800, 4000), legs=LEGS):
+    """
+    Checks that a NumPy port gives the same positions as the metafunction
+    of the hub program (evaluated element-wise) over two cycles of each leg.
+    Raises a ValueError if it doesn't.
+    """
+    for period in periods:
+        t = np.arange(0, 2 * period, 7, dtype=float)
+        for _, factor, shift in legs:
+            kwargs = {'period': period, 't_shift': shift * period}
+            expected = np.frompyfunc(metafunction(factor, **kwargs), 1, 1)(t).astype(float)
+            if not np.allclose(vectorized(factor, **kwargs)(t), expected):
+                raise ValueError("The NumPy port of " + metafunction.__name__
+                                 + " doesn't match the hub program (update VECTORIZED)")
+
+
+def load_metafunction(name='atat_walk', program=ATAT_PROGRAM, periods=(800, 4000)):
+    """
+    Loads a metafunction from a hub program. If it has a NumPy port (in
+    VECTORIZED), it returns the port instead, after checking that it gives
+    the same positions as the hub version (so that the port can't silently
+    drift from the program when the gait changes).
+
+    Parameters
+    ----------
+    name: string
+        Name of the metafunction.
+        Default value is 'atat_walk'.
+
+    program: string
+        Path to the hub program.
+
+    periods: list
+        Periods (in ms) at which the port is checked. Pass the ones
+        that are going to be analyzed.
+        Default value is (800, 4000).
+
+    Returns
+    -------
+    metafunction: function
+    """
+    clock = hub_mock.VirtualClock()
+    modules = {'utime': hub_mock.make_utime(clock), 'hub': hub_mock.make_hub({})}
+    metafunction = hub_mock.load_program(program, modules)[name]
+    if name in VECTORIZED:
+        check_vectorized(metafunction, VECTORIZED[name], periods)
+        return VECTORIZED[name]
+    return metafunction
+
+
+def evaluate(function, t):
+    """
+    Evaluates a motor function on a time grid.
+
+    Functions that work with arrays (e.g., the ones in VECTORIZED) are
+    evaluated in one call. Other functions with branches (which don't work
+    with arrays) are evaluated element-wise.
+
+    Parameters
+    ----------
+    function: function
+        Motor function (of the ticks).
+
+    t: ndarray
+        Time grid (in ms).
+
+    Returns
+    -------
+    values: ndarray
+        Motor position (in degrees) for each element of t.
+    """
+    try:
+        values = np.asarray(function(t), dtype=float)
+        if values.shape == t.shape:
+            return values
+    except (TypeError, ValueError):
+        pass
+    return np.frompyfunc(function, 1, 1)(t).astype(float)
+
+
+def analyze_gait(metafunction, period, legs=LEGS, dt=1, cycles=2, airborne_ratio=1.0, limits=None):
+    """
+    Analyzes the feasibility of a walking pattern.
+
+    Parameters
+    ----------
+    metafunction: function
+        Metafunction with the signature of atat_walk (factor, period, t_shift).
+
+    period: integer
+        Period of the walking cycle (in ms).
+
+    legs: list
+        (name, factor, shift as a fraction of the period) of each leg.
+        Default value is the AT-AT MS5 legs.
+
+    dt: float
+        Resolution of the time grid (in ms).
+        Default value is 1.
+
+    cycles: integer
+        Number of periods to evaluate.
+        Default value is 2.
+
+    airborne_ratio: float
+        A leg is considered to be in the air while it moves faster than
+        airborne_ratio times its mean speed (for atat_walk, the leg moves
+        three times faster in the air than on the ground).
+        Default value is 1.0.
+
+    limits: dict
+        Motor limits (see DEFAULT_LIMITS). Missing keys take the default value.
+
+    Returns
+    -------
+    report: dict
+        Peak values per leg, number of legs in the air and the violated limits.
+    """
+    limits = dict(DEFAULT_LIMITS, **(limits or {}))
+    t = np.arange(0, cycles * period + dt, dt, dtype=float)
+
+    # Positions of all legs at once (legs x samples).
+    positions = np.vstack([evaluate(metafunction(factor, period=period, t_shift=shift * period), t)
+                           for _, factor, shift in legs])
+
+    steps = np.diff(positions, axis=1)
+    velocities = steps / dt * 1000 # degrees/s
+    velocity_steps = np.diff(velocities, axis=1)
+    accelerations = velocity_steps / dt * 1000 # degrees/s^2
+
+    # Position jumps and velocity steps (kinks) are also reported separately.
+    # A kink is a change of velocity within a single sample, while the
+    # samples around it barely change. Notice that at a kink, the acceleration
+    # grows as the grid gets finer (it is the velocity step divided by dt).
+    # That's why the acceleration limit isn't checked by default: for a
+    # piecewise-linear gait like atat_walk, use the velocity step limit.
+    jumps = np.abs(steps) > limits['max_jump']
+    changes = np.abs(velocity_steps)
+    padded = np.pad(changes, ((0, 0), (1, 1)))
+    isolated = (padded[:, :-2] < changes / 2) & (padded[:, 2:] < changes / 2)
+    kinks = (changes > VELOCITY_TOLERANCE) & isolated
+
+    speeds = np.abs(velocities)
+    airborne = speeds > airborne_ratio * speeds.mean(axis=1, keepdims=True)
+    n_airborne = airborne.sum(axis=0)
+
+    peak_velocity = speeds.max(axis=1)
+    peak_acceleration = np.abs(accelerations).max(axis=1)
+    peak_velocity_step = np.where(kinks, changes, 0).max(axis=1)
+
+    report = {
+        'period': period,
+        'legs': {},
+        'max_airborne': int(n_airborne.max()),
+        'multiple_airborne_fraction': float((n_airborne > 1).mean()),
+        'violations': [],
+    }
+    for ii, (name, _, _) in enumerate(legs):
+        report['legs'][name] = {
+            'peak_velocity': float(peak_velocity[ii]),
+            'peak_acceleration': float(peak_acceleration[ii]),
+            'peak_velocity_step': float(peak_velocity_step[ii]),
+            'jumps': int(jumps[ii].sum()),
+            'velocity_steps': int(kinks[ii].sum()),
+        }
+
+    checks = [
+        ('max_velocity', peak_velocity.max()),
+        ('max_acceleration', peak_acceleration.max()),
+        ('max_velocity_step', peak_velocity_step.max()),
+        ('max_jump', np.abs(steps).max()),
+        ('max_airborne', n_airborne.max()),
+    ]
+    for limit, value in checks:
+        if limits[limit] is not None and value > limits[limit]:
+            report['violations'].append((limit, float(value)))
+    report['feasible'] = not report['violations']
+    return report
+
+
+def print_report(report):
+    print("Period = " + str(report['period']) + " ms: " + ("feasible" if report['feasible'] else "NOT feasible"))
+    print("Leg  Peak velocity  Peak acceleration  Peak velocity step  Jumps  Velocity steps")
+    for name, leg in report['legs'].items():
+        print("%-4s %13.1f  %17.1f  %18.1f  %5d  %14d" % (
+            name, leg['peak_velocity'], leg['peak_acceleration'], leg['peak_velocity_step'],
+            leg['jumps'], leg['velocity_steps']))
+    print("Max legs in the air at once: " + str(report['max_airborne'])
+          + " (more than one during %.1f%% of the time)" % (100 * report['multiple_airborne_fraction']))
+    for limit, value in report['violations']:
+        print("  Exceeds " + limit + " (" + "%.1f" % value + ")")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check whether the motors can follow a walking pattern.")
+    parser.add_argument('--program', default=ATAT_PROGRAM, help="hub program with the metafunction")
+    parser.add_argument('--metafunction', default='atat_walk', help="name of the metafunction")
+    parser.add_argument('--period', type=int, default=4000, help="walking period (in ms)")
+    parser.add_argument('--sweep', help="range of periods to check as start:stop:step (in ms)")
+    parser.add_argument('--dt', type=float, default=1, help="resolution of the time grid (in ms)")
+    parser.add_argument('--max-velocity', type=float, default=DEFAULT_LIMITS['max_velocity'], help="in degrees/s")
+    parser.add_argument('--max-acceleration', type=float, default=DEFAULT_LIMITS['max_acceleration'],
+                        help="in degrees/s^2 (not checked by default, since at a velocity step it depends on --dt)")
+    parser.add_argument('--max-velocity-step', type=float, default=DEFAULT_LIMITS['max_velocity_step'], help="in degrees/s")
+    parser.add_argument('--max-jump', type=float, default=DEFAULT_LIMITS['max_jump'], help="in degrees")
+    parser.add_argument('--max-airborne', type=int, default=DEFAULT_LIMITS['max_airborne'], help="legs in the air at once")
+    args = parser.parse_args()
+
+    if args.sweep:
+        start, stop, step = [int(value) for value in args.sweep.split(':')]
+        periods = range(start, stop + 1, step)
+    else:
+        periods = [args.period]
+    metafunction = load_metafunction(args.metafunction, args.program, periods)
+    limits = {
+        'max_velocity': args.max_velocity,
+        'max_acceleration': args.max_acceleration,
+        'max_velocity_step': args.max_velocity_step,
+        'max_jump': args.max_jump,
+        'max_airborne': args.max_airborne,
+    }
+
+    if not args.sweep:
+        print_report(analyze_gait(metafunction, args.period, dt=args.dt, limits=limits))
+        return
+
+    shortest = None
+    print("Period  Peak velocity  Peak velocity step  Max airborne  Feasible")
+    for period in periods:
+        report = analyze_gait(metafunction, period, dt=args.dt, limits=limits)
+        legs = report['legs'].values()
+        print("%6d  %13.1f  %18.1f  %12d  %s" % (
+            period, max(leg['peak_velocity'] for leg in legs), max(leg['peak_velocity_step'] for leg in legs),
+            report['max_airborne'], "yes" if report['feasible'] else "no (" + ", ".join(v[0] for v in report['violations']) + ")"))
+        if report['feasible'] and shortest is None:
+            shortest = period
+    if shortest is None:
+        print("None of the periods is feasible.")
+    else:
+        print("Shortest feasible period: " + str(shortest) + " ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Parallel tuning of the AT-AT MS5 walking parameters.
+
+It searches over Kp, ramp_pwm, the period T and the shift of each leg,
+evaluating every candidate with atat_simulator (on a virtual clock) in a
+separate process. At the end, it prints the Pareto front of walking speed
+(walking cycles per minute, i.e., 60000 / T) against tracking error: the
+candidates for which there is no other one that is both faster and more
+accurate.
+
+Usage:
+    python tools/gait_tuner.py --mode grid --kp 0.8 1.2 1.6 --ramp-pwm 25 50 100 --period 2000 3000 4000
+    python tools/gait_tuner.py --mode random --samples 2000 --shift-jitter 0.05 --csv results.csv
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import random
+
+from atat_simulator import LEGS, simulate_atat
+
+# Periods must be a multiple of this value (in ms), so that they are
+# always a multiple of the resolution of the GaitTable. Random periods
+# are rounded to it and grid periods are checked.
+PERIOD_STEP = 10
+
+
+def grid_candidates(kps, ramp_pwms, periods, shift_jitter=0):
+    """
+    Generates every combination of the given values.
+
+    If shift_jitter is not 0, the shift of each leg also takes the values
+    -shift_jitter, 0 and +shift_jitter (as a fraction of the period) around
+    its nominal value.
+    """
+    if shift_jitter:
+        jitters = list(itertools.product([-shift_jitter, 0, shift_jitter], repeat=len(LEGS)))
+    else:
+        jitters = [(0,) * len(LEGS)]
+    for kp, ramp_pwm, period, jitter in itertools.product(kps, ramp_pwms, periods, jitters):
+        yield {'Kp': kp, 'ramp_pwm': ramp_pwm, 'period': period, 'shift_jitter': jitter}
+
+
+def random_candidates(n_samples, kp_range, ramp_pwm_range, period_range, shift_jitter=0, seed=0):
+    """
+    Generates n_samples random candidates (uniformly distributed in the given ranges).
+    """
+    generator = random.Random(seed)
+    for _ in range(n_samples):
+        yield {
+            'Kp': generator.uniform(*kp_range),
+            'ramp_pwm': generator.uniform(*ramp_pwm_range),
+            'period': int(generator.uniform(*period_range)) // PERIOD_STEP * PERIOD_STEP,
+            'shift_jitter': tuple(generator.uniform(-shift_jitter, shift_jitter) for _ in LEGS),
+        }
+
+
+def evaluate(candidate, duration_ms=8000, motor_params=None):
+    """
+    Simulates one candidate.
+
+    Returns
+    -------
+    result: dict
+        The candidate, together with its speed (walking cycles per minute)
+        and its tracking error (RMS and max, in degrees).
+    """
+    period = candidate['period']
+    t_shifts = [int((shift + jitter) * period) for (_, _, shift), jitter in zip(LEGS, candidate['shift_jitter'])]
+    results = simulate_atat(period=period, Kp=candidate['Kp'], ramp_pwm=candidate['ramp_pwm'], t_shifts=t_shifts,
+                            duration_ms=duration_ms, motor_params=motor_params)
+    result = dict(candidate)
+    result['t_shifts'] = t_shifts
+    result['speed'] = 60000 / period
+    result['rms_error'] = results['rms_error']
+    result['max_error'] = results['max_error']
+    return result
+
+
+def _evaluate(arguments):
+    # Pool.imap only passes one argument.
+    return evaluate(*arguments)
+
+
+def pareto_front(results):
+    """
+    Returns the results that aren't dominated by any other one
+    (i.e., no other result is at least as fast and more accurate, or faster
+    and at least as accurate), sorted from fastest to slowest.
+    """
+    front = []
+    best_error = float('inf')
+    for result in sorted(results, key=lambda r: (-r['speed'], r['rms_error'])):
+        if result['rms_error'] < best_error:
+            front.append(result)
+            best_error = result['rms_error']
+    return front
+
+
+def tune(candidates, workers=None, duration_ms=8000, motor_params=None):
+    """
+    Evaluates all candidates in parallel.
+
+    Parameters
+    ----------
+    candidates: iterable
+        Candidates (dicts with Kp, ramp_pwm, period and shift_jitter).
+
+    workers: integer
+        Number of processes. If None, one per CPU.
+
+    duration_ms: integer
+        Duration of each simulation (in virtual ms).
+
+    motor_params: dict
+        Keyword arguments for SimulatedMotor.
+
+    Returns
+    -------
+    results: list
+    """
+    arguments = ((candidate, duration_ms, motor_params) for candidate in candidates)
+    with multiprocessing.Pool(workers) as pool:
+        return list(pool.imap_unordered(_evaluate, arguments, chunksize=4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the AT-AT MS5 walking parameters in simulation.")
+    parser.add_argument('--mode', choices=['grid', 'random'], default='random', help="search strategy")
+    parser.add_argument('--kp', type=float, nargs='+', default=[0.6, 2.5], help="values (grid) or range (random) of Kp")
+    parser.add_argument('--ramp-pwm', type=float, nargs='+', default=[10, 100], help="values (grid) or range (random) of ramp_pwm")
+    parser.add_argument('--period', type=int, nargs='+', default=[1000, 4000], help="values (grid) or range (random) of the period (in ms)")
+    parser.add_argument('--shift-jitter', type=float, default=0, help="maximum change of the shift of each leg (as a fraction of the period)")
+    parser.add_argument('--samples', type=int, default=500, help="number of candidates (random only)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (random only)")
+    parser.add_argument('--duration', type=int, default=8000, help="duration of each simulation (in ms)")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument('--load', type=float, default=10, help="load friction of the simulated motors (in pwm)")
+    parser.add_argument('--backlash', type=float, default=0, help="backlash of the simulated motors (in degrees)")
+    parser.add_argument('--csv', help="save all results in this CSV file")
+    args = parser.parse_args()
+
+    if args.mode == 'grid':
+        for period in args.period:
+            if period <= 0 or period % PERIOD_STEP:
+                parser.error("--period values must be positive multiples of " + str(PERIOD_STEP) + " ms (got " + str(period) + ")")
+        candidates = list(grid_candidates(args.kp, args.ramp_pwm, args.period, args.shift_jitter))
+    else:
+        for name in ['kp', 'ramp_pwm', 'period']:
+            if len(getattr(args, name)) != 2:
+                parser.error("--" + name.replace('_', '-') + " needs a minimum and a maximum in random mode")
+        candidates = list(random_candidates(args.samples, args.kp, args.ramp_pwm, args.period,
+                                            args.shift_jitter, args.seed))
+
+    print("Evaluating " + str(len(candidates)) + " candidates...")
+    results = tune(candidates, workers=args.workers, duration_ms=args.duration,
+                   motor_params={'load': args.load, 'backlash': args.backlash})
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Kp', 'ramp_pwm', 'period', 't_shifts', 'speed', 'rms_error', 'max_error'])
+            for result in results:
+                writer.writerow([result['Kp'], result['ramp_pwm'], result['period'],
+                                 ' '.join(str(t_shift) for t_shift in result['t_shifts']),
+                                 result['speed'], result['rms_error'], result['max_error']])
+
+    print("Pareto front (fastest first):")
+    print("Period  Cycles/min     Kp  ramp_pwm  RMS error  Max error  t_shifts (A B E F)")
+    for result in pareto_front(results):
+        print("%6d  %10.1f  %5.2f  %8.1f  %9.2f  %9.2f  %s" % (
+            result['period'], result['speed'], result['Kp'], result['ramp_pwm'],
+            result['rms_error'], result['max_error'], ' '.join(str(t_shift) for t_shift in result['t_shifts'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,636 @@
+"""
+Host-side stand-ins for the MINDSTORMS hub.
+
+This module lets you run parts of the hub programs of this repository on
+a regular computer (e.g., to benchmark a controller in CI). It provides:
+
+* VirtualClock: a clock that only moves forward when something waits
+  (or when a motor command "takes time"). It runs much faster than real time.
+* A fake utime module (ticks_ms, ticks_us, ticks_diff, sleep_ms...) driven
+  by the virtual clock. Ticks wrap around exactly like in MicroPython.
+* SimulatedMotor: a replacement of hub.port.X.motor based on a first order
+  DC motor model with load and backlash.
+* A fake hub module (hub.port.A.motor, ...).
+* A fake uasyncio module whose event loop runs on the virtual clock.
+* Fake mindstorms modules (MSHub, Motor, DistanceSensor, App...), made of
+  FakeDevice objects that simply take some (virtual) time for every call.
+* FakeLogger: a replacement of the log of the hub programs, on top of
+  Python's logging module.
+* load_program: extracts the classes and functions of a hub program
+  (without running its main code) using the fake modules.
+"""
+
+import ast
+import heapq
+import logging
+import math
+import sys
+import types
+
+# MicroPython's ticks_ms() and ticks_us() wrap around at 2**30.
+TICKS_PERIOD = 1 << 30
+
+
+class VirtualClock():
+    """
+    Simulated clock (in us).
+
+    Every time the clock advances, the registered devices (e.g., motors)
+    are integrated in steps of at most step_us. Listeners are called after
+    each step, which is handy for recording the state of the simulation.
+
+    Parameters
+    ----------
+    step_us: integer
+        Maximum integration step (in us).
+        Default value is 250.
+
+    start_us: integer
+        Initial value of the clock (in us). Use a value close to TICKS_PERIOD
+        (in ms or us) to test what happens when the hub ticks wrap around.
+        Default value is 0.
+    """
+    def __init__(self, step_us=250, start_us=0):
+        self.step_us = step_us
+        self.now_us = start_us
+        self.devices = []
+        self.listeners = []
+
+    def add_device(self, device):
+        self.devices.append(device)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def advance(self, us):
+        """
+        Moves the clock forward us microseconds.
+        """
+        while us > 0:
+            dt = min(us, self.step_us)
+            for device in self.devices:
+                device.step(dt)
+            self.now_us += dt
+            us -= dt
+            for listener in self.listeners:
+                listener(self.now_us)
+
+
+def make_utime(clock, call_us=0):
+    """
+    Creates a fake utime module driven by a VirtualClock.
+
+    Parameters
+    ----------
+    clock: VirtualClock
+
+    call_us: integer
+        Duration of every call to ticks_ms or ticks_us (in us). With a value
+        other than 0, a loop that does nothing but check the time (or a
+        cached value) still moves forward.
+        Default value is 0.
+
+    Returns
+    -------
+    utime: module
+    """
+    utime = types.ModuleType('utime')
+
+    def ticks_ms():
+        if call_us:
+            clock.advance(call_us)
+        return (clock.now_us // 1000) % TICKS_PERIOD
+
+    def ticks_us():
+        if call_us:
+            clock.advance(call_us)
+        return clock.now_us % TICKS_PERIOD
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) % TICKS_PERIOD
+
+    def ticks_diff(ticks1, ticks2):
+        return ((ticks1 - ticks2 + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+    def sleep_us(us):
+        clock.advance(int(us))
+
+    def sleep_ms(ms):
+        clock.advance(int(ms * 1000))
+
+    def sleep(seconds):
+        clock.advance(int(seconds * 1000000))
+
+    utime.ticks_ms = ticks_ms
+    utime.ticks_us = ticks_us
+    utime.ticks_add = ticks_add
+    utime.ticks_diff = ticks_diff
+    utime.sleep_us = sleep_us
+    utime.sleep_ms = sleep_ms
+    utime.sleep = sleep
+    return utime
+
+
+class SimulatedMotor():
+    """
+    Replacement of hub.port.X.motor.
+
+    The motor is modelled as a first order system: with a constant pwm,
+    its speed exponentially approaches pwm/100 * max_speed with time
+    constant tau. The load adds a (Coulomb) friction, expressed as the pwm
+    needed to overcome it. The encoder sits on the motor shaft, while the
+    output (e.g., the leg) is coupled to it through some backlash. While the
+    gear teeth are not touching, the motor doesn't feel the load.
+
+    Each call to get(), pwm(), preset() and run_to_position() also takes
+    some (virtual) time, just like a round-trip to the port of the hub.
+
+    Parameters
+    ----------
+    clock: VirtualClock
+        Clock used to simulate the duration of each call.
+
+    max_speed: float
+        No-load speed at full pwm (in degrees/s).
+        Default value is 1000.
+
+    tau: float
+        Time constant of the motor (in s).
+        Default value is 0.05.
+
+    load: float
+        Friction of the load (in pwm). The motor doesn't move with less pwm than this.
+        Default value is 10.
+
+    backlash: float
+        Total play between the motor and the output (in degrees).
+        Default value is 0.
+
+    position: float
+        Initial (absolute) position of the motor (in degrees).
+        Default value is 0.
+
+    call_us: integer or dict
+        Duration of each call (in us). A dict allows giving a different
+        duration to each method (e.g., {'get': 200, 'pwm': 100}).
+        Default value is 100.
+    """
+    RUN_TO_POSITION_KP = 2
+    RUN_TO_POSITION_MIN_PWM = 25
+    RUN_TO_POSITION_TOLERANCE = 2
+
+    def __init__(self, clock, max_speed=1000, tau=0.05, load=10, backlash=0, position=0, call_us=100):
+        self.clock = clock
+        self.max_speed = max_speed
+        self.tau = tau
+        self.load = load
+        self.backlash = backlash
+        if isinstance(call_us, dict):
+            self.call_us = call_us
+        else:
+            self.call_us = {'get': call_us, 'pwm': call_us, 'preset': call_us, 'run_to_position': call_us}
+
+        self.position = float(position) # Motor shaft (in degrees)
+        self.output_position = float(position) # Output shaft (in degrees)
+        self.speed = 0.0 # In degrees/s
+        self.offset = -float(position) # Relative encoder = position + offset
+        self.command = 0 # pwm
+        self.target = None # Target of run_to_position (in relative degrees)
+        self.target_speed = 0
+
+        self.counts = {'get': 0, 'pwm': 0, 'preset': 0, 'run_to_position': 0}
+        clock.add_device(self)
+
+    def __call_cost(self, method):
+        self.counts[method] += 1
+        self.clock.advance(self.call_us.get(method, 0))
+
+    # Motor API.
+    def get(self):
+        self.__call_cost('get')
+        return [
+            int(round(100 * self.speed / self.max_speed)),
+            int(round(self.position + self.offset)),
+            int(round(self.position)) % 360,
+            self.current_pwm(),
+        ]
+
+    def pwm(self, value):
+        self.__call_cost('pwm')
+        self.target = None
+        self.command = int(min(max(value, -100), 100))
+
+    def preset(self, position):
+        self.__call_cost('preset')
+        self.offset = position - self.position
+
+    def run_to_position(self, position, speed=None, *args, **kwargs):
+        self.__call_cost('run_to_position')
+        self.target = position
+        self.target_speed = 100 if speed is None else abs(speed)
+
+    def float(self):
+        self.target = None
+        self.command = 0
+
+    def brake(self):
+        self.float()
+        self.speed = 0.0
+
+    # Simulation.
+    def current_pwm(self):
+        if self.target is None:
+            return self.command
+
+        # Firmware-like position controller for run_to_position.
+        # Once the motor gets to its target, it brakes.
+        error = self.target - (self.position + self.offset)
+        if abs(error) <= self.RUN_TO_POSITION_TOLERANCE:
+            self.brake()
+            return 0
+        pwm = math.copysign(max(abs(self.RUN_TO_POSITION_KP * error), self.RUN_TO_POSITION_MIN_PWM), error)
+        return int(min(max(pwm, -self.target_speed), self.target_speed))
+
+    def step(self, dt_us):
+        dt = dt_us / 1000000
+        pwm = self.current_pwm()
+
+        # Is the motor pushing the load (i.e., has it taken up the backlash)?
+        gap = self.position - self.output_position
+        half_backlash = self.backlash / 2
+        engaged = abs(gap) >= half_backlash
+
+        drive = pwm
+        if engaged:
+            if abs(self.speed) > 1e-6:
+                drive -= math.copysign(self.load, self.speed)
+            elif abs(pwm) <= self.load:
+                drive = 0
+            else:
+                drive -= math.copysign(self.load, pwm)
+
+        # Exact solution of the first order system for a constant drive.
+        steady_speed = drive / 100 * self.max_speed
+        decay = math.exp(-dt / self.tau)
+        new_speed = steady_speed + (self.speed - steady_speed) * decay
+        self.position += steady_speed * dt + (self.speed - steady_speed) * self.tau * (1 - decay)
+
+        # Friction can stop the motor, but never make it turn backwards.
+        if engaged and drive != pwm and self.speed * new_speed < 0:
+            new_speed = 0.0
+        self.speed = new_speed
+
+        gap = self.position - self.output_position
+        if gap > half_backlash:
+            self.output_position = self.position - half_backlash
+        elif gap < -half_backlash:
+            self.output_position = self.position + half_backlash
+
+
+def make_hub(motors, extras=None):
+    """
+    Creates a fake hub module.
+
+    Parameters
+    ----------
+    motors: dict
+        Motor of each port (e.g., {'A': SimulatedMotor(clock)}).
+
+    extras: dict
+        Other attributes of the module (e.g., {'sound': FakeDevice(clock)}).
+        Default value is None.
+
+    Returns
+    -------
+    hub: module
+    """
+    hub = types.ModuleType('hub')
+    hub.port = types.SimpleNamespace()
+    for port, motor in motors.items():
+        setattr(hub.port, port, types.SimpleNamespace(motor=motor))
+    for name, value in (extras or {}).items():
+        setattr(hub, name, value)
+    return hub
+
+
+class FakeDevice():
+    """
+    Generic stand-in for anything of the hub that we don't simulate
+    (e.g., MSHub, App, hub.sound or a Motor of the mindstorms module).
+
+    Any attribute is another FakeDevice, and calling one takes some (virtual)
+    time and returns None (unless a return function is given for it). For
+    example, hub.light_matrix.show_image('HAPPY') takes call_us.
+
+    Parameters
+    ----------
+    clock: VirtualClock
+
+    call_us: integer
+        Duration of each call (in us).
+        Default value is 500.
+
+    durations: dict
+        Duration (in us) of specific methods, by name (e.g., {'move': 1000000}).
+        Default value is None.
+
+    returns: dict
+        Function that gives the return value of specific methods, by name
+        (e.g., {'get_distance_cm': lambda: 10}).
+        Default value is None.
+    """
+    def __init__(self, clock, call_us=500, durations=None, returns=None, name=''):
+        self._clock = clock
+        self._call_us = call_us
+        self._durations = durations or {}
+        self._returns = returns or {}
+        self._name = name
+        self._children = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name not in self._children:
+            self._children[name] = FakeDevice(self._clock, self._call_us, self._durations, self._returns, name)
+        return self._children[name]
+
+    def __call__(self, *args, **kwargs):
+        self._clock.advance(self._durations.get(self._name, self._call_us))
+        if self._name in self._returns:
+            return self._returns[self._name]()
+        return None
+
+
+class FakeLogger():
+    """
+    Stand-in for the log of the hub programs (a Logger), which they create in
+    their main code (and thus, load_program doesn't).
+
+    Messages are passed to Python's logging module, so they are only shown
+    if it is configured (e.g., logging.basicConfig(level=logging.DEBUG)).
+    every_ms is ignored. The levels have the same values as in Logger.
+
+    Parameters
+    ----------
+    name: string
+        Name of the Python logger.
+        Default value is 'hub'.
+    """
+    DEBUG = logging.DEBUG
+    INFO = logging.INFO
+    WARNING = logging.WARNING
+    ERROR = logging.ERROR
+
+    def __init__(self, name='hub'):
+        self._logger = logging.getLogger(name)
+
+    def enabled(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, message, *args, every_ms=0):
+        self._logger.debug(message, *args)
+
+    def info(self, message, *args, every_ms=0):
+        self._logger.info(message, *args)
+
+    def warning(self, message, *args, every_ms=0):
+        self._logger.warning(message, *args)
+
+    def error(self, message, *args, every_ms=0):
+        self._logger.error(message, *args)
+
+
+def make_mindstorms(clock, call_us=500, durations=None, returns=None):
+    """
+    Creates fake mindstorms, mindstorms.control and mindstorms.operator modules.
+
+    Every device (MSHub(), Motor('A'), DistanceSensor('D')...) is a FakeDevice
+    (see it for the parameters). wait_for_seconds sleeps on the virtual clock.
+
+    Returns
+    -------
+    modules: dict
+        The modules, by name (to use with load_program or sys.modules).
+    """
+    mindstorms = types.ModuleType('mindstorms')
+    for name in ['MSHub', 'Motor', 'MotorPair', 'ColorSensor', 'DistanceSensor', 'ForceSensor', 'App']:
+        setattr(mindstorms, name, lambda *args, **kwargs: FakeDevice(clock, call_us, durations, returns))
+
+    control = types.ModuleType('mindstorms.control')
+    control.wait_for_seconds = lambda seconds: clock.advance(int(seconds * 1000000))
+
+    def wait_until(get_value, operator_or_value=None, target_value=None):
+        while True:
+            if target_value is not None:
+                done = operator_or_value(get_value(), target_value)
+            elif operator_or_value is not None:
+                done = get_value() == operator_or_value
+            else:
+                done = get_value()
+            if done:
+                return
+            clock.advance(1000)
+    control.wait_until = wait_until
+
+    class Timer():
+        def __init__(self):
+            self.start_us = clock.now_us
+
+        def reset(self):
+            self.start_us = clock.now_us
+
+        def now(self):
+            return (clock.now_us - self.start_us) // 1000000
+    control.Timer = Timer
+
+    operator = types.ModuleType('mindstorms.operator')
+    operator.greater_than = lambda a, b: a > b
+    operator.greater_than_or_equal_to = lambda a, b: a >= b
+    operator.less_than = lambda a, b: a < b
+    operator.less_than_or_equal_to = lambda a, b: a <= b
+    operator.equal_to = lambda a, b: a == b
+    operator.not_equal_to = lambda a, b: a != b
+
+    mindstorms.control = control
+    mindstorms.operator = operator
+    return {'mindstorms': mindstorms, 'mindstorms.control': control, 'mindstorms.operator': operator}
+
+
+class _Sleep():
+    # Awaitable that asks the event loop to resume the task at wake_us.
+    def __init__(self, wake_us):
+        self.wake_us = wake_us
+
+    def __await__(self):
+        yield self
+
+
+def make_uasyncio(clock):
+    """
+    Creates a fake uasyncio module whose event loop runs on a VirtualClock.
+
+    It supports what the hub programs use: run, create_task, gather, sleep,
+    sleep_ms, Task.cancel and CancelledError. When all tasks are waiting,
+    the clock jumps to the next wake-up time.
+
+    Parameters
+    ----------
+    clock: VirtualClock
+
+    Returns
+    -------
+    uasyncio: module
+    """
+    uasyncio = types.ModuleType('uasyncio')
+    queue = [] # (wake_us, sequence, task, token)
+    sequence = [0]
+
+    class CancelledError(BaseException):
+        pass
+
+    class Task():
+        def __init__(self, coroutine):
+            self.coroutine = coroutine
+            self.done = False
+            self.result = None
+            self.exception = None
+            self.waiters = []
+            self.token = 0
+            self.cancelling = False
+            schedule(self, clock.now_us)
+
+        def cancel(self):
+            if self.done:
+                return False
+            self.cancelling = True
+            schedule(self, clock.now_us)
+            return True
+
+        def __await__(self):
+            while not self.done:
+                yield self
+            if self.exception is not None:
+                raise self.exception
+            return self.result
+
+    def schedule(task, wake_us):
+        task.token += 1
+        sequence[0] += 1
+        heapq.heappush(queue, (wake_us, sequence[0], task, task.token))
+
+    def step(task):
+        try:
+            if task.cancelling:
+                task.cancelling = False
+                request = task.coroutine.throw(CancelledError())
+            else:
+                request = task.coroutine.send(None)
+        except StopIteration as stop:
+            finish(task, stop.value, None)
+            return
+        except BaseException as exception:
+            finish(task, None, exception)
+            return
+
+        if isinstance(request, _Sleep):
+            schedule(task, request.wake_us)
+        elif isinstance(request, Task):
+            request.waiters.append(task)
+        else:
+            schedule(task, clock.now_us)
+
+    def finish(task, result, exception):
+        task.done = True
+        task.result = result
+        task.exception = exception
+        for waiter in task.waiters:
+            schedule(waiter, clock.now_us)
+
+    def run(coroutine):
+        main = Task(coroutine)
+        while not main.done:
+            if not queue:
+                raise RuntimeError("All tasks are waiting for each other")
+            wake_us, _, task, token = heapq.heappop(queue)
+            if token != task.token or task.done:
+                continue
+            if wake_us > clock.now_us:
+                clock.advance(wake_us - clock.now_us)
+            step(task)
+        del queue[:]
+        if main.exception is not None:
+            raise main.exception
+        return main.result
+
+    def sleep(seconds):
+        return _Sleep(clock.now_us + int(seconds * 1000000))
+
+    def sleep_ms(ms):
+        return _Sleep(clock.now_us + int(ms * 1000))
+
+    async def gather(*awaitables):
+        tasks = [awaitable if isinstance(awaitable, Task) else Task(awaitable) for awaitable in awaitables]
+        return [await task for task in tasks]
+
+    uasyncio.CancelledError = CancelledError
+    uasyncio.Task = Task
+    uasyncio.create_task = Task
+    uasyncio.run = run
+    uasyncio.sleep = sleep
+    uasyncio.sleep_ms = sleep_ms
+    uasyncio.gather = gather
+    return uasyncio
+
+
+def load_program(path, modules, names=None):
+    """
+    Loads the classes and functions defined in a hub program.
+
+    Only the imports (including try/except blocks made only of imports, which
+    hub programs use for optional modules) and the (top level) class and
+    (async) function definitions are executed. The rest of the program (e.g., its
+    main loop) is ignored.
+
+    Parameters
+    ----------
+    path: string
+        Path to the .py file of the program.
+
+    modules: dict
+        Fake modules to use instead of the hub ones (e.g., {'utime': utime, 'hub': hub}).
+
+    names: dict
+        Fake objects that the main code of the program would create and its
+        classes and functions use (e.g., {'log': FakeLogger()}).
+        Default value is None.
+
+    Returns
+    -------
+    namespace: dict
+        Names defined by the program.
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    imports = (ast.Import, ast.ImportFrom)
+
+    def is_import_fallback(node):
+        return (isinstance(node, ast.Try)
+                and all(isinstance(child, imports) for child in node.body)
+                and all(isinstance(child, imports) for handler in node.handlers for child in handler.body))
+
+    tree.body = [node for node in tree.body
+                 if isinstance(node, imports + (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) or is_import_fallback(node)]
+
+    namespace = {'__name__': 'hub_program'}
+    namespace.update(names or {})
+    previous = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        exec(compile(tree, path, 'exec'), namespace)
+    finally:
+        for name, module in previous.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    return namespace
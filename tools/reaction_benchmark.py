@@ -0,0 +1,254 @@
+"""
+Detection-to-reaction latency benchmark of the obstacle-triggered programs.
+
+It runs a whole hub program (Charlie's Shy Guy and Surprise!, and the
+AAT MS5) on a virtual clock with fake mindstorms, hub, utime and uasyncio
+modules. In every trial, an obstacle appears in front of the distance
+sensor at a random time and the program runs until it reacts to it. The
+ReactionProbe of the program measures the time between the sensor read
+that crossed the threshold and the first actuator command. On top of that,
+since here we know when the obstacle actually appeared, the benchmark also
+reports the end-to-end latency (from the obstacle to the command) and the
+sampling delay (from the obstacle to the read that saw it).
+
+Every call to a device takes some (virtual) time, and so does every print.
+Thus, the results are only as good as these durations, but they are very
+handy to compare two versions of a program (e.g., in CI with --max-p95-ms).
+
+Usage:
+    python tools/reaction_benchmark.py --trials 200
+    python tools/reaction_benchmark.py --program shy_guy --print-us 2000 --json
+    python tools/reaction_benchmark.py --max-p95-ms 50
+"""
+
+import argparse
+import array
+import json
+import os
+import random
+import sys
+
+import hub_mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROGRAMS = {
+    'shy_guy': os.path.join(ROOT, 'base', 'charlie', 'programs', 'shy_guy.py'),
+    'surprise': os.path.join(ROOT, 'base', 'charlie', 'programs', 'surprise.py'),
+    'aat_ms5': os.path.join(ROOT, 'mocs', 'aat_ms5', 'programs', 'aat_ms5.py'),
+}
+
+# Distance (in cm) that the sensor gives without and with the obstacle.
+# The obstacle is closer than the threshold of every program.
+FAR_CM = 200
+NEAR_CM = 5
+
+
+class TrialDone(BaseException):
+    # Stops the program after its first reaction. It is a BaseException,
+    # so that the program (or the fake uasyncio) can't swallow it.
+    pass
+
+
+class TrialTimeout(BaseException):
+    pass
+
+
+def run_trial(path, delay_us, call_us=500, sensor_us=2000, print_us=1000, ticks_us=10, timeout_ms=60000, seed=0):
+    """
+    Runs a hub program until it reacts to an obstacle.
+
+    Parameters
+    ----------
+    path: string
+        Path to the hub program.
+
+    delay_us: integer
+        Time between the first read of the distance sensor and the
+        appearance of the obstacle (in us).
+
+    call_us: integer
+        Duration of every call to a device (in us).
+        Default value is 500.
+
+    sensor_us: integer
+        Duration of a read of the distance sensor (in us).
+        Default value is 2000.
+
+    print_us: integer
+        Duration of a print (in us).
+        Default value is 1000.
+
+    ticks_us: integer
+        Duration of a call to utime.ticks_us or utime.ticks_ms (in us).
+        Default value is 10.
+
+    timeout_ms: integer
+        Maximum duration of the trial (in virtual ms).
+        Default value is 60000.
+
+    seed: integer
+        Seed of the random module of the program.
+
+    Returns
+    -------
+    result: dict
+        Reaction latency (as measured by the probe), end-to-end latency
+        and sampling delay (in us).
+    """
+    clock = hub_mock.VirtualClock()
+    obstacle = {'first_read_us': None, 'appears_us': None}
+
+    def get_distance_cm():
+        if obstacle['first_read_us'] is None:
+            obstacle['first_read_us'] = clock.now_us
+            obstacle['appears_us'] = clock.now_us + delay_us
+        return NEAR_CM if clock.now_us >= obstacle['appears_us'] else FAR_CM
+
+    durations = {'get_distance_cm': sensor_us, 'move': 1000000, 'run_for_degrees': 500000,
+                 'run_to_position': 500000, 'run_for_seconds': 1000000}
+    returns = {'get_distance_cm': get_distance_cm}
+    modules = hub_mock.make_mindstorms(clock, call_us, durations, returns)
+    modules['utime'] = hub_mock.make_utime(clock, ticks_us)
+    modules['uasyncio'] = hub_mock.make_uasyncio(clock)
+    modules['array'] = array
+    modules['random'] = random.Random(seed)
+    motors = {port: hub_mock.SimulatedMotor(clock, load=2) for port in 'ABCEF'}
+    extras = {name: hub_mock.FakeDevice(clock, call_us, name=name) for name in ['led', 'sound', 'display']}
+    extras['Image'] = hub_mock.FakeDevice(clock, 0, name='Image')
+    modules['hub'] = hub_mock.make_hub(motors, extras)
+
+    namespace = {'__name__': '__main__', 'print': lambda *args, **kwargs: clock.advance(print_us)}
+    start_us = clock.now_us
+
+    def check(now_us):
+        probe = namespace.get('probe')
+        if probe is not None and probe.n_trials > 0:
+            raise TrialDone()
+        if now_us - start_us > timeout_ms * 1000:
+            raise TrialTimeout()
+    clock.add_listener(check)
+
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    saved_modules = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        exec(code, namespace)
+    except TrialDone:
+        pass
+    except TrialTimeout:
+        raise RuntimeError(os.path.basename(path) + " didn't react within " + str(timeout_ms) + " ms")
+    finally:
+        for name, module in saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+    probe = namespace['probe']
+    if probe.n_trials == 0:
+        raise RuntimeError(os.path.basename(path) + " ended without reacting")
+    latency_us = probe.latencies[0]
+    return {
+        'latency_us': latency_us,
+        'end_to_end_us': probe.last_trigger_ticks + latency_us - obstacle['appears_us'],
+        'sampling_delay_us': probe.last_trigger_ticks - obstacle['appears_us'],
+    }
+
+
+def summarize(values):
+    """
+    Returns the min, median, p90, p95 and max of a list of values.
+    """
+    values = sorted(values)
+    n = len(values)
+    return {
+        'min': values[0],
+        'median': values[n // 2],
+        'p90': values[min(n - 1, 9 * n // 10)],
+        'p95': values[min(n - 1, 95 * n // 100)],
+        'max': values[-1],
+    }
+
+
+def benchmark(path, trials=100, window_ms=200, seed=0, **kwargs):
+    """
+    Runs many trials of a hub program, with the obstacle appearing at a
+    random time (uniformly distributed in the first window_ms after the
+    first read). Other keyword arguments are passed to run_trial.
+
+    Returns
+    -------
+    results: dict
+        The values of every trial and their summary (in us).
+    """
+    generator = random.Random(seed)
+    trials = [run_trial(path, generator.randrange(window_ms * 1000), seed=generator.randrange(1 << 30), **kwargs)
+              for _ in range(trials)]
+    results = {}
+    for key in ['latency_us', 'end_to_end_us', 'sampling_delay_us']:
+        values = [trial[key] for trial in trials]
+        results[key] = {'values': values, 'summary': summarize(values)}
+    return results
+
+
+def print_histogram(values, bin_ms=5):
+    counts = {}
+    for value in values:
+        counts[value // (bin_ms * 1000)] = counts.get(value // (bin_ms * 1000), 0) + 1
+    for low in sorted(counts):
+        print("  %4d-%-4d ms: %s (%d)" % (low * bin_ms, (low + 1) * bin_ms, '#' * counts[low], counts[low]))
+
+
+def print_results(name, results, bin_ms=5):
+    print(name + " (" + str(len(results['latency_us']['values'])) + " trials)")
+    print("                        min   median      p90      p95      max  (ms)")
+    for key, label in [('latency_us', "Reaction latency"), ('end_to_end_us', "End-to-end latency"),
+                       ('sampling_delay_us', "Sampling delay")]:
+        summary = results[key]['summary']
+        print("%-20s %6.1f %8.1f %8.1f %8.1f %8.1f" % (
+            label, summary['min'] / 1000, summary['median'] / 1000, summary['p90'] / 1000,
+            summary['p95'] / 1000, summary['max'] / 1000))
+    print("End-to-end latency:")
+    print_histogram(results['end_to_end_us']['values'], bin_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how fast the obstacle-triggered programs react.")
+    parser.add_argument('--program', choices=sorted(PROGRAMS), nargs='+', default=sorted(PROGRAMS), help="programs to benchmark")
+    parser.add_argument('--trials', type=int, default=100, help="number of trials per program")
+    parser.add_argument('--window', type=int, default=200, help="the obstacle appears within this time after the first read (in ms)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--call-us', type=int, default=500, help="duration of every call to a device (in us)")
+    parser.add_argument('--sensor-us', type=int, default=2000, help="duration of a read of the distance sensor (in us)")
+    parser.add_argument('--print-us', type=int, default=1000, help="duration of a print (in us)")
+    parser.add_argument('--ticks-us', type=int, default=10, help="duration of a call to utime.ticks_us or utime.ticks_ms (in us)")
+    parser.add_argument('--bin', type=int, default=5, help="width of the histogram bins (in ms)")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--max-p95-ms', type=float, help="fail (exit code 1) if the p95 end-to-end latency of a program exceeds this value")
+    args = parser.parse_args()
+
+    all_results = {}
+    for name in args.program:
+        all_results[name] = benchmark(PROGRAMS[name], trials=args.trials, window_ms=args.window, seed=args.seed,
+                                      call_us=args.call_us, sensor_us=args.sensor_us, print_us=args.print_us,
+                                      ticks_us=args.ticks_us)
+
+    if args.json:
+        print(json.dumps({name: {key: value['summary'] for key, value in results.items()}
+                          for name, results in all_results.items()}, indent=2))
+    else:
+        for name, results in all_results.items():
+            print_results(name, results, args.bin)
+
+    if args.max_p95_ms is not None:
+        slow = [name for name, results in all_results.items()
+                if results['end_to_end_us']['summary']['p95'] > args.max_p95_ms * 1000]
+        if slow:
+            print("p95 end-to-end latency above " + str(args.max_p95_ms) + " ms: " + ", ".join(slow))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Reads the telemetry recorded by Mechanism.dump_telemetry in the hub.
+
+The file starts with two 32-bit integers (number of motors and number of
+records). Then, each record has the ticks, followed by the target, position
+and pwm of each motor (all of them 32-bit little-endian integers).
+
+Copy the file from the hub to your computer and then:
+    python tools/telemetry_reader.py atat_telemetry.bin > atat_telemetry.csv
+    python tools/telemetry_reader.py atat_telemetry.bin --summary
+"""
+
+import argparse
+import math
+import struct
+
+
+def read_telemetry(filename):
+    """
+    Reads a telemetry file.
+
+    Parameters
+    ----------
+    filename: string
+        Path to the file written by Mechanism.dump_telemetry.
+
+    Returns
+    -------
+    n_motors: integer
+        Number of motors.
+
+    records: list
+        One tuple per control cycle: (ticks, target_0, position_0, pwm_0, target_1, ...).
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    n_motors, n_records = struct.unpack_from('<2i', data)
+    record_size = 1 + 3 * n_motors
+    record_format = '<' + str(record_size) + 'i'
+    offset = struct.calcsize('<2i')
+    records = []
+    for ii in range(n_records):
+        records.append(struct.unpack_from(record_format, data, offset + ii * record_size * 4))
+    return n_motors, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read the telemetry recorded by a Mechanism in the hub.")
+    parser.add_argument('filename', help="telemetry file")
+    parser.add_argument('--summary', action='store_true', help="print the tracking error of each motor instead of the records")
+    args = parser.parse_args()
+
+    n_motors, records = read_telemetry(args.filename)
+    if args.summary:
+        print("Records: " + str(len(records)))
+        for motor in range(n_motors):
+            errors = [record[1 + 3 * motor] - record[2 + 3 * motor] for record in records]
+            if errors:
+                rms = math.sqrt(sum(error * error for error in errors) / len(errors))
+                print("Motor %d: RMS error = %.2f; max error = %d" % (motor, rms, max(abs(error) for error in errors)))
+        return
+
+    print("ticks" + "".join(",target_%d,position_%d,pwm_%d" % (ii, ii, ii) for ii in range(n_motors)))
+    for record in records:
+        print(",".join(str(value) for value in record))
+
+
+if __name__ == '__main__':
+    main()